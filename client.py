@@ -5,36 +5,63 @@ import mss
 import time
 import json
 import io
+import os
+import threading
+import collections
+import itertools
+import contextlib
+import random
+import secrets
+import socket
+import struct
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
+import numpy as np
 import pyautogui
 import zlib
 import pyaudio
+import protocol
+import mux
 
 # Configuration
 BASE_URI = "localhost"
 WEB_INTERFACE_PORT = 12312312
 WEB_URI = f"http://{BASE_URI}:{WEB_INTERFACE_PORT}"
-CONTROL_SENDER_PORT = 1232352
-IMAGE_RECEIVER_PORT = 123523
-VOICE_SENDER_PORT = 123524
-
-LAST_CONTROL_SENDER_PORT = CONTROL_SENDER_PORT
-LAST_IMAGE_RECEIVER_PORT = IMAGE_RECEIVER_PORT
+MUX_PORT = 7777  # Screen, control, audio and config share one connection to this port
+HOST_ID = socket.gethostname()  # Names this machine's session on the server
+RESUME_TOKEN = secrets.token_hex(8)  # Sent on every connection, so the server can tell a reconnect of this client from a new one
+RECONNECT_DELAY = 0.25  # Seconds before the first retry, doubling up to RECONNECT_DELAY_MAX
+RECONNECT_DELAY_MAX = 5
+PING_INTERVAL = 2  # A dead link is noticed within PING_INTERVAL + PING_TIMEOUT seconds
+PING_TIMEOUT = 6
 
 
 pyautogui.FAILSAFE = False
+pyautogui.PAUSE = 0  # Queued events are replayed back to back; the default 0.1 s pause per call backs them up
 
 
 SCREEN_WIDTH, SCREEN_HEIGHT = pyautogui.size()
 SCREEN_RESOLUTION_MULTIPLIER = 1
 REFRESH_RATE = 15
 
-async def safe_websocket_connect(uri, retries=5, delay=3):
+# Delta streaming
+TILE_SIZE = 64  # Edge length of the tiles compared between frames
+FRAME_CODEC = protocol.CODEC_JPEG  # JPEG, WEBP, PNG or RAW
+JPEG_QUALITY = 80  # Upper bound for the adaptive controller
+KEYFRAME_INTERVAL = 10  # Seconds between forced full frames
+FULL_FRAME_RATIO = 0.5  # Send a full frame when more than this share of tiles changed
+MOVE_MIN_RATIO = 0.1  # Look for a scrolled or moved region once more than this share of tiles changed
+MOVE_MIN_ROWS = 8  # Rows (or columns) that must agree on a shift before it is used
+HASH_SAMPLE_STEP = 4  # Row hashes cover every 4th pixel; the tiles sent after a copy fix any row they miss
+HASH_WEIGHTS = np.random.default_rng(0).integers(1, 2**63, size=65536 // HASH_SAMPLE_STEP + 1, dtype=np.uint64) | np.uint64(1)
+
+async def safe_websocket_connect(uri, retries=5, delay=RECONNECT_DELAY):
     """Attempts to connect to a WebSocket with retries, preventing total failure."""
     attempt = 0
     while True:
         try:
-            websocket = await websockets.connect(uri, ping_interval=10, ping_timeout=20)
+            websocket = await websockets.connect(uri, ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT)
             print(f"✅ Connected to {uri} safely.")
             return websocket
         except Exception as e:
@@ -42,177 +69,799 @@ async def safe_websocket_connect(uri, retries=5, delay=3):
             print(f"❌ Failed to connect to {uri} (Attempt {attempt}/{retries}): {e}")
             if attempt >= retries:
                 print("❌ Maximum retries reached. Retrying indefinitely...")
-            await asyncio.sleep(delay * min(2**attempt, 30))  # Exponential backoff, max 30s delay
+            # Exponential backoff from a fraction of a second, so a brief outage costs a brief pause. The jitter
+            # keeps hosts that lost the server together from retrying in lockstep.
+            await asyncio.sleep(min(RECONNECT_DELAY_MAX, delay * 2 ** (attempt - 1)) * random.uniform(0.5, 1))
 
 
 '''
 ________________________________________________________________________________________________________________________________________________________________________________________________________________________________________________
 '''
 
-async def capture_and_send():
-    """Captures the screen and sends images over WebSocket with reconnect logic."""
-    global SCREEN_RESOLUTION_MULTIPLIER
-    URI = f"ws://{BASE_URI}:{IMAGE_RECEIVER_PORT}"
-    print(f"⚙ Connecting to {URI} for Image Streaming")
+def frame_flags(rendition=0):
+    """Returns the frame flags for the configured codec and a rendition."""
+    # JPEG, WebP and PNG are already compressed; only raw pixels are worth deflating
+    flags = protocol.FLAG_DEFLATE if FRAME_CODEC == protocol.CODEC_RAW else 0
+    return flags | protocol.rendition_flags(rendition)
 
-    while True:  # Keep retrying indefinitely
+
+@contextlib.contextmanager
+def stage_timer(timings, stage):
+    """Adds the CPU time the calling thread spends in the block to timings[stage], if a timings dict is given.
+    Waits for the GIL or for a free pool worker are not counted, so the block must not hand work to another thread."""
+    start_time = time.thread_time()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0) + time.thread_time() - start_time
+
+
+def encode_image(pixels, quality=JPEG_QUALITY, timings=None):
+    """Encodes a BGRA array with the configured codec."""
+    if FRAME_CODEC == protocol.CODEC_RAW:
+        with stage_timer(timings, "encode"):
+            data = np.ascontiguousarray(pixels[..., 2::-1]).tobytes()
+        with stage_timer(timings, "compress"):
+            return zlib.compress(data, level=1)
+    with stage_timer(timings, "encode"):
+        height, width = pixels.shape[:2]
+        # The BGRX unpacker drops alpha and swaps to RGB as the encoder reads the pixels, with no extra copy
+        image = Image.frombuffer("RGB", (width, height), np.ascontiguousarray(pixels), "raw", "BGRX", 0, 1)
+        img_buffer = io.BytesIO()
+        image.save(img_buffer, format=protocol.CODEC_FORMATS[FRAME_CODEC], quality=quality)
+        return img_buffer.getvalue()
+
+
+def find_dirty_tiles(frame, previous, tile_size=TILE_SIZE):
+    """Returns (x, y, w, h) of every tile that differs between two frames of the same shape."""
+    height, width = frame.shape[:2]
+    rows = -(-height // tile_size)
+    cols = -(-width // tile_size)
+
+    # Pad the per-pixel change mask so it splits evenly into tiles, then reduce each tile at once
+    changed = np.zeros((rows * tile_size, cols * tile_size), dtype=bool)
+    # One 32-bit comparison per BGRA pixel instead of one per channel
+    np.not_equal(frame.view(np.uint32)[..., 0], previous.view(np.uint32)[..., 0], out=changed[:height, :width])
+    dirty = changed.reshape(rows, tile_size, cols, tile_size).any(axis=(1, 3))
+
+    tiles = []
+    for row, col in zip(*np.nonzero(dirty)):
+        x, y = int(col) * tile_size, int(row) * tile_size
+        tiles.append((x, y, min(tile_size, width - x), min(tile_size, height - y)))
+    return tiles
+
+
+def row_hashes(pixels):
+    """Hashes every row of a BGRA region in one pass, sampling every HASH_SAMPLE_STEP-th pixel."""
+    sampled = pixels[:, ::HASH_SAMPLE_STEP].view(np.uint32)[..., 0]
+    return (sampled.astype(np.uint64) * HASH_WEIGHTS[:sampled.shape[1]]).sum(axis=1, dtype=np.uint64)
+
+
+def find_shift(current, previous):
+    """Returns the offset s for which the most rows satisfy current[i] == previous[i + s], or 0 if none
+    is supported by MOVE_MIN_ROWS rows. Only rows that start a run of identical rows vote, and only
+    when no other run in previous starts the same way, so blank space and flat areas cannot mislead it."""
+    starts_now = np.flatnonzero(np.r_[True, current[1:] != current[:-1]])
+    starts_before = np.flatnonzero(np.r_[True, previous[1:] != previous[:-1]])
+    values, first, counts = np.unique(previous[starts_before], return_index=True, return_counts=True)
+    queries = current[starts_now]
+    positions = np.searchsorted(values, queries).clip(max=len(values) - 1)
+    found = (values[positions] == queries) & (counts[positions] == 1)
+    shifts = starts_before[first[positions[found]]] - starts_now[found]
+    shifts = shifts[shifts != 0]
+    if len(shifts) < MOVE_MIN_ROWS:
+        return 0
+    votes = np.bincount(shifts + len(current))
+    best = int(votes.argmax())
+    return best - len(current) if votes[best] >= MOVE_MIN_ROWS else 0
+
+
+def matched_span(current, previous, shift):
+    """Returns the first and last index i with current[i] == previous[i + shift]."""
+    indices = np.arange(max(0, -shift), min(len(current), len(previous) - shift))
+    matches = indices[current[indices] == previous[indices + shift]]
+    return int(matches[0]), int(matches[-1])
+
+
+def find_move(frame, previous, box):
+    """Looks inside box (x0, y0, x1, y1) for content of previous that reappears shifted vertically or
+    horizontally in frame, as when a window scrolls. Returns a copy (sx, sy, w, h, dx, dy) or None."""
+    x0, y0, x1, y1 = box
+    current, before = frame[y0:y1, x0:x1], previous[y0:y1, x0:x1]
+    rows_now, rows_before = row_hashes(current), row_hashes(before)
+    shift = find_shift(rows_now, rows_before)
+    if shift:
+        first, last = matched_span(rows_now, rows_before, shift)
+        return x0, y0 + first + shift, x1 - x0, last - first + 1, x0, y0 + first
+    columns_now, columns_before = row_hashes(current.transpose(1, 0, 2)), row_hashes(before.transpose(1, 0, 2))
+    shift = find_shift(columns_now, columns_before)
+    if shift:
+        first, last = matched_span(columns_now, columns_before, shift)
+        return x0 + first + shift, y0, last - first + 1, y1 - y0, x0 + first, y0
+    return None
+
+
+def plan_frame(frame, previous, force_keyframe=False):
+    """Returns (copies, tiles) for a delta frame, ([], []) if nothing changed, or None for a full frame.
+
+    When many tiles changed, the frame is checked for a region that moved since the previous one. If
+    copying it on the viewer leaves fewer tiles to send, only the copy and the exposed strip are sent.
+    """
+    if force_keyframe or previous is None or previous.shape != frame.shape:
+        return None
+    tiles = find_dirty_tiles(frame, previous)
+    height, width = frame.shape[:2]
+    total_tiles = -(-height // TILE_SIZE) * -(-width // TILE_SIZE)
+    copies = []
+    if len(tiles) > MOVE_MIN_RATIO * total_tiles:
+        box = (min(x for x, _, _, _ in tiles), min(y for _, y, _, _ in tiles),
+               max(x + w for x, _, w, _ in tiles), max(y + h for _, y, _, h in tiles))
+        copy = find_move(frame, previous, box)
+        if copy is not None:
+            sx, sy, w, h, dx, dy = copy
+            predicted = previous.copy()  # What the viewer shows once the copy is applied
+            predicted[dy:dy + h, dx:dx + w] = previous[sy:sy + h, sx:sx + w]
+            moved_tiles = find_dirty_tiles(frame, predicted)
+            if len(moved_tiles) < len(tiles):
+                copies, tiles = [copy], moved_tiles
+    if len(tiles) > FULL_FRAME_RATIO * total_tiles:
+        return None
+    return copies, tiles
+
+
+def plan_renditions(frames, previous_frames, forced, timings=None):
+    """Plans every rendition of a capture; see plan_frame."""
+    with stage_timer(timings, "diff"):
+        return {rendition: plan_frame(frame, previous_frames.get(rendition), forced[rendition]) for rendition, frame in frames.items()}
+
+
+def encode_frame(frame, header, plan, quality=JPEG_QUALITY, timings=None):
+    """Encodes a planned frame into a message: the whole image if plan is None, else its copies and tiles."""
+    if plan is None:
+        return protocol.pack_full_frame(header, encode_image(frame, quality, timings))
+    copies, tiles = plan
+    images = ((x, y, w, h, encode_image(frame[y:y + h, x:x + w], quality, timings)) for x, y, w, h in tiles)
+    if copies:
+        return protocol.pack_copy_frame(header, copies, images)
+    return protocol.pack_tile_frame(header, images)
+
+
+def encode_renditions(frames, headers, plans, quality=JPEG_QUALITY, timings=None):
+    """Encodes the planned renditions of a capture into one message each, sharpest first."""
+    return [encode_frame(frames[rendition], headers[rendition], plans[rendition], quality, timings) for rendition in sorted(headers)]
+
+
+# Adaptive quality
+ADAPTIVE_QUALITY = True
+TARGET_LATENCY = 0.25  # Seconds from capture to viewer paint
+BANDWIDTH_BUDGET = 0  # Bytes per second, 0 for unlimited
+SEND_BUFFER_LIMIT = 256 * 1024  # Bytes waiting in the socket before the link counts as congested
+MIN_QUALITY = 20
+MIN_REFRESH_RATE = 2
+MIN_RESOLUTION_MULTIPLIER = 0.25
+CONTROL_INTERVAL = 0.5  # Seconds between controller adjustments
+
+
+class AdaptiveController:
+    """Tunes JPEG quality, frame rate and scale to stay within the latency and bandwidth targets.
+
+    The configured JPEG_QUALITY, REFRESH_RATE and SCREEN_RESOLUTION_MULTIPLIER are caps. Under
+    congestion quality is cut first, then frame rate, then resolution; recovery runs in reverse.
+    """
+
+    def __init__(self):
+        self.quality = JPEG_QUALITY
+        self.refresh_rate = REFRESH_RATE
+        self.resolution_multiplier = SCREEN_RESOLUTION_MULTIPLIER
+        self.unacked = collections.deque(maxlen=1024)  # (sequence, capture time) of frames no viewer has painted
+        self.latency = 0.0  # Capture-to-paint time of the last acknowledged frame
+        self.viewers = 0
+        self.buffered = 0
+        self.reset_window(time.time())
+
+    def reset_window(self, now):
+        self.window_start = now
+        self.window_bytes = 0
+        self.window_send_time = 0.0
+
+    def record_frame(self, sequence, captured_at):
+        self.unacked.append((sequence, captured_at))
+
+    def record_send(self, size, seconds, buffered):
+        self.window_bytes += size
+        self.window_send_time += seconds
+        self.buffered = buffered
+
+    def record_feedback(self, acked, viewers):
+        """Applies a server report of the slowest viewer's newest painted frame."""
+        self.viewers = viewers
+        if acked is None:
+            return
+        while self.unacked and (acked - self.unacked[0][0]) & 0xFFFFFFFF < 0x80000000:
+            sequence, captured_at = self.unacked.popleft()
+            if sequence == acked:
+                self.latency = time.time() - captured_at
+
+    def is_congested(self, now, elapsed):
+        latency = 0.0
+        if self.viewers:
+            latency = self.latency
+            if self.unacked:
+                latency = max(latency, now - self.unacked[0][1])  # A stalled viewer sends no acks at all
+        return (
+            latency > TARGET_LATENCY
+            or self.buffered > SEND_BUFFER_LIMIT
+            or (BANDWIDTH_BUDGET and self.window_bytes / elapsed > BANDWIDTH_BUDGET)
+            or self.window_send_time / elapsed > 0.5  # The socket was blocked for half of the window
+        )
+
+    def back_off(self):
+        if self.quality > MIN_QUALITY:
+            self.quality = max(MIN_QUALITY, int(self.quality * 0.7))
+        elif self.refresh_rate > MIN_REFRESH_RATE:
+            self.refresh_rate = max(MIN_REFRESH_RATE, self.refresh_rate * 0.7)
+        else:
+            self.resolution_multiplier = max(MIN_RESOLUTION_MULTIPLIER, round(self.resolution_multiplier * 0.75, 2))
+
+    def recover(self):
+        if self.resolution_multiplier < SCREEN_RESOLUTION_MULTIPLIER:
+            self.resolution_multiplier = round(self.resolution_multiplier + 0.05, 2)
+        elif self.refresh_rate < REFRESH_RATE:
+            self.refresh_rate += 1
+        elif self.quality < JPEG_QUALITY:
+            self.quality += 5
+
+    def update(self):
+        """Adjusts the settings once per CONTROL_INTERVAL."""
+        now = time.time()
+        elapsed = now - self.window_start
+        if elapsed < CONTROL_INTERVAL:
+            return
+        if not ADAPTIVE_QUALITY:
+            self.quality, self.refresh_rate = JPEG_QUALITY, REFRESH_RATE
+            self.resolution_multiplier = SCREEN_RESOLUTION_MULTIPLIER
+        elif self.is_congested(now, elapsed):
+            self.back_off()
+        else:
+            self.recover()
+
+        # The configured values may have been lowered since the last update
+        self.quality = min(self.quality, JPEG_QUALITY)
+        self.refresh_rate = min(self.refresh_rate, REFRESH_RATE)
+        self.resolution_multiplier = min(self.resolution_multiplier, SCREEN_RESOLUTION_MULTIPLIER)
+        self.reset_window(now)
+
+
+# Capture scheduling
+INTERACTIVE_REFRESH_RATE = 30  # Frame rate while the viewer is using the mouse or keyboard
+INTERACTIVE_BOOST = 3  # Never more than this times the controller's rate, so a congested link is not flooded
+INTERACTIVE_WINDOW = 2  # Seconds after the last control event that count as interactive
+IDLE_REFRESH_RATE = 1  # Heartbeat rate once the screen has stopped changing
+IDLE_AFTER = 2  # Seconds without a change before dropping to the heartbeat
+
+
+class CaptureScheduler:
+    """Decides when to grab next: fast right after input, at the configured rate while the screen
+    changes, and at a slow heartbeat once it has been static for IDLE_AFTER seconds. Capture stops
+    altogether while the server reports that no viewer is watching."""
+
+    def __init__(self):
+        self.last_input = 0
+        self.last_change = time.time()
+        self.last_digest = None
+        self.input_arrived = asyncio.Event()
+        self.viewers = None  # Unknown until the server reports, so capture runs as before
+        self.watched = asyncio.Event()
+        self.watched.set()
+        self.keyframe_requested = False
+        self.renditions = (0,)  # Renditions the viewers watch; only the full size until the server reports
+        self.sent_sequence = None  # Sequence number of the newest frame handed to the socket
+        self.resume_from = None  # sent_sequence when the connection was last replaced
+        self.resuming = False  # Until the server's first report over the new connection
+
+    def record_renditions(self, renditions):
+        """Applies the renditions the server's viewers watch, keeping the full size while there are none."""
+        wanted = {int(rendition) for rendition in renditions}
+        self.renditions = tuple(sorted(wanted & set(range(len(protocol.RENDITION_SCALES))))) or (0,)
+
+    def record_viewers(self, viewers, watching):
+        """Applies the server's viewer counts. Returns True when capture resumes."""
+        self.viewers = viewers
+        if watching and not self.watched.is_set():
+            self.watched.set()
+            self.request_keyframe()  # Viewers may hold a stale picture, and the screen may have changed while paused
+            return True
+        if not watching:
+            self.watched.clear()
+        return False
+
+    def begin_resume(self):
+        """Remembers the last frame sent before a (re)connect, to compare with what the server has."""
+        self.resume_from = self.sent_sequence
+        self.resuming = True
+
+    def finish_resume(self, resumed):
+        """Applies the first server report after a (re)connect. Deltas carry on only if the server resumed
+        the session and has every frame sent before the drop; otherwise the next frame is a keyframe."""
+        if not self.resuming:
+            return
+        self.resuming = False
+        if resumed != self.resume_from:
+            self.request_keyframe()  # Sent even if the screen has not changed: the server may have nothing
+
+    def request_keyframe(self):
+        """Makes the next grab a keyframe, even if the screen has not changed since the last one."""
+        self.keyframe_requested = True
+        self.last_digest = None
+
+    def take_keyframe_request(self):
+        requested, self.keyframe_requested = self.keyframe_requested, False
+        return requested
+
+    def record_input(self):
+        self.last_input = time.time()
+        self.input_arrived.set()
+
+    def record_grab(self, digest, grabbed_at):
+        """Returns whether the grab differs from the previous one."""
+        if digest == self.last_digest:
+            return False
+        self.last_digest = digest
+        self.last_change = grabbed_at
+        return True
+
+    def interval(self, refresh_rate):
+        now = time.time()
+        if now - self.last_input < INTERACTIVE_WINDOW:
+            return 1 / max(refresh_rate, min(INTERACTIVE_REFRESH_RATE, refresh_rate * INTERACTIVE_BOOST))
+        if now - self.last_change > IDLE_AFTER:
+            return 1 / min(refresh_rate, IDLE_REFRESH_RATE)
+        return 1 / refresh_rate
+
+    async def wait(self, started, refresh_rate):
+        """Sleeps until the next grab is due, cutting an idle wait short when input arrives."""
         try:
-            websocket = await safe_websocket_connect(URI)
-            if not websocket:
-                await asyncio.sleep(5)
-                continue  # Retry connection
-
-            with mss.mss() as sct:
-                monitor = sct.monitors[1]
-                while True:
-                    start_time = time.time()
-                    screenshot = sct.grab(monitor)
-                    img = Image.frombytes("RGB", screenshot.size, screenshot.rgb)
-
-                    img = img.resize((
-                        int(SCREEN_WIDTH * SCREEN_RESOLUTION_MULTIPLIER),
-                        int(SCREEN_HEIGHT * SCREEN_RESOLUTION_MULTIPLIER)
-                    ))
-
-                    img_buffer = io.BytesIO()
-                    img.save(img_buffer, format="JPEG", quality=50)
-                    compressed_data = zlib.compress(img_buffer.getvalue(), level=9)
-                    await websocket.send(compressed_data)
-
-                    elapsed_time = time.time() - start_time
-                    await asyncio.sleep(max(0, 1 / REFRESH_RATE - elapsed_time))
-
-        except (asyncio.CancelledError, websockets.exceptions.ConnectionClosedError):
-            print("🔄 WebSocket connection lost, attempting reconnect...")
-            await asyncio.sleep(5)  # Wait before retrying
-        except Exception as e:
-            print(f"❌ Unexpected error in capture_and_send: {e}")
-            await asyncio.sleep(5)  # Avoid rapid failures
+            await asyncio.wait_for(self.input_arrived.wait(), max(0, started + self.interval(refresh_rate) - time.time()))
+        except asyncio.TimeoutError:
+            pass
+        self.input_arrived.clear()
+        # Input switches to the interactive interval, which still spaces out the grabs
+        await asyncio.sleep(max(0, started + self.interval(refresh_rate) - time.time()))
+
+
+# Capture pipeline: grab -> convert/scale -> plan/encode -> send.
+# Stages hand each other futures through bounded queues, so up to PIPELINE_DEPTH frames are
+# converted and encoded in parallel while the event loop stays free for control and audio.
+ENCODE_WORKERS = os.cpu_count() or 2
+PIPELINE_DEPTH = max(2, ENCODE_WORKERS)
+grab_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="grab")  # mss handles are per-thread
+encode_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="encode")
+grab_state = threading.local()
+# Scaled frames are written round-robin into these; more than the frames the pipeline can hold at once:
+# PIPELINE_DEPTH queued plus one being queued per stage, the encoder's current and previous, one being sent
+REDUCE_BUFFERS = 2 * PIPELINE_DEPTH + 4
+MAX_REDUCE_FACTOR = 16  # Larger blocks would overflow the 16-bit sums
+reduce_outputs = {}  # (width, height, factor) -> (output arrays, counter picking the next one)
+reduce_lock = threading.Lock()
+reduce_scratch = threading.local()  # Each encode worker's 16-bit sums, by (width, height, factor)
+METRICS_INTERVAL = 1  # Seconds between stage timing reports
+METRICS_BACKLOG = 1000  # Frame timings kept while a report cannot be sent
+
+
+def grab_screen():
+    """Grabs the primary monitor. Runs on the grab thread, which keeps its mss handle open."""
+    if not hasattr(grab_state, "sct"):
+        grab_state.sct = mss.mss()
+    return grab_state.sct.grab(grab_state.sct.monitors[1])
+
+
+def grab_and_digest(timings=None):
+    """Grabs the screen plus a cheap checksum of its raw pixels, used to skip unchanged grabs."""
+    with stage_timer(timings, "grab"):
+        screenshot = grab_screen()
+    with stage_timer(timings, "hash"):
+        return screenshot, zlib.adler32(screenshot.raw)
+
+
+def bgra_view(screenshot):
+    """Returns the grab's raw BGRA pixels as a height x width x 4 array that shares their memory."""
+    width, height = screenshot.size
+    return np.frombuffer(screenshot.raw, dtype=np.uint8).reshape(height, -1, 4)[:, :width]  # Drops any row padding
+
+
+def prepare_renditions(screenshot, sizes, timings=None):
+    """Returns the grab at the size of every rendition, keyed by rendition."""
+    return {rendition: prepare_frame(screenshot, size, timings) for rendition, size in sizes.items()}
+
+
+def prepare_frame(screenshot, size, timings=None):
+    """Returns a grab as a BGRA array at the streaming resolution. At full size this is the grab itself."""
+    with stage_timer(timings, "resize"):
+        width, height = screenshot.size
+        if size == (width, height):
+            return bgra_view(screenshot)
+        factor = width // size[0]
+        if 1 < factor <= MAX_REDUCE_FACTOR and (width // factor, height // factor) == size:
+            return reduce_frame(bgra_view(screenshot), factor, size)
+        # Other factors: PIL sees 4-channel RGBX but never reorders channels, so the result is still BGRA
+        stride = len(screenshot.raw) // height
+        image = Image.frombuffer("RGBX", screenshot.size, screenshot.raw, "raw", "RGBX", stride, 1)
+        return np.asarray(image.resize(size, Image.Resampling.BOX, reducing_gap=2.0))
+
+
+def reduce_frame(pixels, factor, size):
+    """Box-averages factor x factor blocks of a BGRA array into a reused output array, like Image.reduce;
+    a few edge pixels may be cut off. Nothing is allocated once a size has been seen on a thread."""
+    width, height = size
+    key = (width, height, factor)
+    with reduce_lock:
+        outputs = reduce_outputs.get(key)
+        if outputs is None:
+            outputs = reduce_outputs[key] = ([np.empty((height, width, 4), np.uint8) for _ in range(REDUCE_BUFFERS)], itertools.count())
+        output = outputs[0][next(outputs[1]) % REDUCE_BUFFERS]
+    buffers = getattr(reduce_scratch, "buffers", None)
+    if buffers is None:
+        buffers = reduce_scratch.buffers = {}
+    if key not in buffers:
+        buffers[key] = (np.empty((height, width * factor, 4), np.uint16), np.empty((height, width, 4), np.uint16))
+    rows, sums = buffers[key]
+    blocks = pixels[:height * factor, :width * factor]
+    np.add(blocks[0::factor], blocks[1::factor], out=rows, dtype=np.uint16)
+    for row in range(2, factor):
+        np.add(rows, blocks[row::factor], out=rows)
+    # Adds each pixel's four 16-bit channel sums as one 64-bit word; they cannot carry into each other
+    pixel_rows = rows.view(np.uint64).reshape(height, width, factor)
+    pixel_sums = sums.view(np.uint64).reshape(height, width)
+    np.add(pixel_rows[:, :, 0], pixel_rows[:, :, 1], out=pixel_sums)
+    for column in range(2, factor):
+        np.add(pixel_sums, pixel_rows[:, :, column], out=pixel_sums)
+    np.add(pixel_sums, np.uint64(0x0001000100010001 * (factor * factor // 2)), out=pixel_sums)  # Rounds to nearest
+    np.floor_divide(sums, factor * factor, out=output, casting="unsafe")
+    return output
+
+
+async def grab_stage(frames, controller, scheduler):
+    """Grabs the screen at the scheduler's rate and queues the conversion of every grab that changed."""
+    loop = asyncio.get_running_loop()
+    while True:
+        if not scheduler.watched.is_set():
+            print("💤 No one is watching, pausing capture.")
+            await scheduler.watched.wait()
+            print("👀 A viewer is watching, resuming capture.")
+        start_time = time.time()
+        timings = {}  # Seconds spent in each stage, reported with the frame's sequence number
+        screenshot, digest = await loop.run_in_executor(grab_pool, grab_and_digest, timings)
+        multiplier = controller.resolution_multiplier
+        renditions = scheduler.renditions
+        # A new scale or rendition changes the frames even if the screen did not
+        if scheduler.record_grab((digest, multiplier, renditions), start_time):
+            width, height = max(1, int(SCREEN_WIDTH * multiplier)), max(1, int(SCREEN_HEIGHT * multiplier))
+            sizes = {}
+            for rendition in renditions:
+                scale = protocol.RENDITION_SCALES[rendition]
+                sizes[rendition] = (max(1, width // scale), max(1, height // scale))
+            # Blocks while the encoders are behind, which lowers the grab rate instead of piling up frames
+            await frames.put((start_time, timings, loop.run_in_executor(encode_pool, prepare_renditions, screenshot, sizes, timings)))
+        await scheduler.wait(start_time, controller.refresh_rate)
+
+
+async def encode_stage(frames, messages, controller, scheduler):
+    """Diffs converted frames in capture order and queues their encoding, one message per rendition."""
+    loop = asyncio.get_running_loop()
+    previous_frames = {}  # Rendition -> its last frame; a fresh connection or a new rendition starts with a keyframe
+    last_keyframes = {}
+    sequence = 0
+    while True:
+        captured_at, timings, converting = await frames.get()
+        renditions = await converting
+        requested = scheduler.take_keyframe_request()
+        forced = {rendition: requested or captured_at - last_keyframes.get(rendition, 0) > KEYFRAME_INTERVAL for rendition in renditions}
+        plans = await loop.run_in_executor(encode_pool, plan_renditions, renditions, previous_frames, forced, timings)
+        previous_frames = renditions  # Renditions nobody watches any more are forgotten
+        plans = {rendition: plan for rendition, plan in plans.items() if plan != ([], [])}
+        if not plans:
+            continue  # Nothing changed on screen
+
+        headers = {}
+        for rendition, plan in plans.items():
+            if plan is None:
+                last_keyframes[rendition] = captured_at
+            height, width = renditions[rendition].shape[:2]
+            headers[rendition] = protocol.make_header(FRAME_CODEC, width, height, sequence, frame_flags(rendition), timestamp=captured_at)
+        header = headers[min(headers)]
+        controller.record_frame(header.sequence, captured_at)
+        sequence += 1
+        encoding = loop.run_in_executor(encode_pool, encode_renditions, renditions, headers, plans, controller.quality, timings)
+        await messages.put((header, timings, encoding))
 
-async def receive_mouse_control():
-    """Receives mouse movements and moves the client mouse."""
-    URI = f"ws://{BASE_URI}:{CONTROL_SENDER_PORT}"
-    websocket = await safe_websocket_connect(URI)
-    if not websocket:
-        return
-    
-    held_keys = set()
-    modifier_keys = {"ctrl", "shift", "alt", "meta"}
 
-    print("🖱️ Connected to mouse control WebSocket")
-    async for message in websocket:
+async def send_stage(connection, messages, controller, scheduler, traces):
+    """Sends encoded frames in capture order on the video channel, timing each send for the controller."""
+    while True:
+        header, timings, encoding = await messages.get()
+        encoded = await encoding
+        start_time = time.time()
+        for message in encoded:
+            await connection.send(protocol.CHANNEL_VIDEO, message)
+            scheduler.sent_sequence = header.sequence
+        size = sum(len(message) for message in encoded)
+        controller.record_send(size, time.time() - start_time, connection.buffered())
+        controller.update()
+        timings["send"] = time.time() - start_time
+        timings["pipeline"] = time.time() - header.timestamp  # Capture to hand-off, including queueing
+        traces.append(dict(timings, sequence=header.sequence, bytes=size))
+
+
+async def report_metrics(connection, traces):
+    """Sends the stage timings of recently sent frames to the server for its /metrics histograms."""
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        if traces:
+            frames = list(traces)
+            traces.clear()
+            await connection.send(protocol.CHANNEL_METRICS, json.dumps({"frames": frames}))
+
+
+def handle_feedback(payload, controller, scheduler):
+    """Feeds the server's viewer acknowledgements to the controller, and its viewer counts and the
+    renditions they watch to the scheduler."""
+    try:
+        data = json.loads(payload)
+        scheduler.finish_resume(data.get("resumed"))
+        viewers = int(data.get("viewers", 0))
+        controller.record_feedback(data.get("acked"), viewers)
+        if "watching" in data and scheduler.record_viewers(viewers, int(data["watching"])):
+            controller.unacked.clear()  # Frames sent before the pause will never be acknowledged
+        if data.get("keyframe"):
+            scheduler.request_keyframe()  # A viewer cannot rebuild the screen from deltas
+        if "renditions" in data:
+            scheduler.record_renditions(data["renditions"])
+    except (json.JSONDecodeError, AttributeError, TypeError, ValueError) as e:
+        print(f"⚠️ Invalid feedback message: {payload} - Error: {e}")
+
+
+async def capture_and_send(connection, controller, scheduler):
+    """Captures the screen and sends changed tiles on the video channel until a stage fails."""
+    frames = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+    messages = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+    traces = collections.deque(maxlen=METRICS_BACKLOG)
+    stages = [
+        asyncio.create_task(grab_stage(frames, controller, scheduler)),
+        asyncio.create_task(encode_stage(frames, messages, controller, scheduler)),
+        asyncio.create_task(send_stage(connection, messages, controller, scheduler, traces)),
+        asyncio.create_task(report_metrics(connection, traces)),
+    ]
+    try:
+        done, _ = await asyncio.wait(stages, return_when=asyncio.FIRST_EXCEPTION)
+        for stage in done:
+            stage.result()  # Re-raise whatever stopped the pipeline
+    finally:
+        for stage in stages:
+            stage.cancel()
+
+# Remote control
+BUTTON_MAP = {0: "left", 1: "middle", 2: "right"}  # Browser button codes
+MODIFIER_KEYS = {"ctrl", "shift", "alt", "win"}
+KEY_ALIASES = {  # Browser key names that pyautogui spells differently
+    "control": "ctrl", "meta": "win", "os": "win", " ": "space", "escape": "esc",
+    "arrowup": "up", "arrowdown": "down", "arrowleft": "left", "arrowright": "right",
+}
+input_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="input")  # One thread keeps events in order
+
+
+def apply_control_event(data, held_keys):
+    """Replays one browser input event with pyautogui."""
+    action = data.get("action", "")
+    x = float(data.get("x", 0)) * SCREEN_WIDTH
+    y = float(data.get("y", 0)) * SCREEN_HEIGHT
+    button = BUTTON_MAP.get(data.get("button", 0), "left")
+    key = str(data.get("key", "")).lower()
+    key = KEY_ALIASES.get(key, key)
+
+    if action == "move":
+        pyautogui.moveTo(x, y)
+
+    elif action == "mousedown":
+        pyautogui.mouseDown(x, y, button=button)
+        print(f"🖱️ Mouse down at: ({x}, {y}) with {button} button")
+
+    elif action == "mouseup":
+        pyautogui.mouseUp(x, y, button=button, duration=0)
+        print(f"🖱️ Mouse up at: ({x}, {y}) with {button} button")
+
+    # Older viewer pages also send synthesized clicks on top of mousedown/mouseup
+    elif action == "click":
+        pyautogui.click(x, y, button=button)
+        print(f"🖱️ Clicked at: ({x}, {y}) with {button} button")
+
+    elif action == "dblclick":
+        pyautogui.doubleClick(x, y)
+
+    elif action == "rightclick":
+        pyautogui.rightClick(x, y)
+
+    elif action == "keydown":
+        pyautogui.keyDown(key)
+        if key in MODIFIER_KEYS:
+            held_keys.add(key)  # Hold modifier key
+
+    elif action == "keyup":
+        pyautogui.keyUp(key)
+        held_keys.discard(key)
+
+
+def apply_control_events(events, held_keys):
+    """Replays a batch of events in order. Runs on the input thread."""
+    for data in events:
         try:
-            data = json.loads(message)
-            action = data.get("action", "")
-            x = float(data.get("x", 0)) * SCREEN_WIDTH
-            y = float(data.get("y", 0)) * SCREEN_HEIGHT
-            button = data.get("button", "left")
-            key = data.get("key", "").lower()
-            data = json.loads(message)
-            action = data.get("action", "")
-            
-            
-
-            # Convert button codes to names
-            button_map = {0: "left", 1: "middle", 2: "right"}
-            button = button_map.get(button, "left")
-
-            if action == "move":
-                pyautogui.moveTo(x, y)  # Smooth movement
-                
-
-            elif action == "click":
-                pyautogui.click(x, y, button=button)
-                print(f"🖱️ Clicked at: ({x}, {y}) with {button} button")
-
-            elif action == "mousedown":
-                pyautogui.mouseDown(x, y, button=button)
-                print(f"🖱️ Mouse down at: ({x}, {y}) with {button} button")
-                
-
-            elif action == "mouseup":
-                pyautogui.mouseUp(x, y, button=button, duration=0)
-                print(f"🖱️ Mouse up at: ({x}, {y}) with {button} button")
-
-            elif action == "dblclick":
-                pyautogui.doubleClick(x, y)
-                # print(f"🖱️ Double clicked at: ({x}, {y})")
-
-            elif action == "rightclick":
-                pyautogui.rightClick(x, y)
-                # print(f"🖱️ Right clicked at: ({x}, {y})")
-
-            elif action == "click":
-                x = float(data.get("x", 0)) * SCREEN_WIDTH
-                y = float(data.get("y", 0)) * SCREEN_HEIGHT
-                button = data.get("button", "left")
-                pyautogui.click(x, y, button=button)
-
-            
-
-            if action == "keydown":
-                if key in modifier_keys:
-                    pyautogui.keyDown(key)  # Hold modifier key
-                    held_keys.add(key)
-                else:
-                    pyautogui.keyDown(key)
-
-            if action == "keyup":
-                if key in held_keys:
-                    pyautogui.keyUp(key)  # Release modifier key
-                    held_keys.remove(key)
-        except asyncio.CancelledError:
-            print("🔄 Task cancelled.")
-            break
-        except (json.JSONDecodeError, KeyError, ValueError) as e:
-            print(f"⚠️ Invalid mouse message format: {message} - Error: {e}")
-                
-        except (json.JSONDecodeError, KeyError, ValueError) as e:
-            print(f"⚠️ Invalid mouse message format: {message} - Error: {e}")
+            apply_control_event(data, held_keys)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            print(f"⚠️ Invalid mouse message format: {data} - Error: {e}")
+
+
+async def receive_mouse_control(control_messages, scheduler):
+    """Replays batches of input events from the control channel on the client in order."""
+    loop = asyncio.get_running_loop()
+    held_keys = set()
+    try:
+        while True:
+            message = await control_messages.get()
+            try:
+                events = protocol.parse_control_message(message)
+            except (ValueError, struct.error) as e:  # JSONDecodeError is a ValueError
+                print(f"⚠️ Invalid mouse message format: {message!r} - Error: {e}")
+                continue
+            # pyautogui blocks, so replay on the input thread and keep the loop free for capture and audio
+            await loop.run_in_executor(input_pool, apply_control_events, events, held_keys)
+            scheduler.record_input()  # The screen is about to change in response; capture it quickly
+    finally:
+        # Never leave a modifier stuck down on the host
+        releases = [{"action": "keyup", "key": key} for key in held_keys]
+        input_pool.submit(apply_control_events, releases, held_keys)
+
+
+# Cursor overlay: the pointer is sampled on its own and sent as tiny updates, so it moves on the
+# viewer's page at CURSOR_RATE even while frames arrive far more slowly
+CURSOR_RATE = 60  # Samples per second; an update is only sent when something changed
+
+if os.name == "nt":
+    import ctypes
+    from ctypes import wintypes
+
+    class CURSORINFO(ctypes.Structure):
+        _fields_ = [("cbSize", wintypes.DWORD), ("flags", wintypes.DWORD), ("hCursor", ctypes.c_void_p), ("ptScreenPos", wintypes.POINT)]
+
+    CURSOR_SHOWING = 0x1
+    user32 = ctypes.windll.user32
+    user32.LoadCursorW.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+    user32.LoadCursorW.restype = ctypes.c_void_p
+    # The shared system cursors (IDC_* resource IDs), by the CSS name the page draws them with
+    WINDOWS_CURSORS = {
+        user32.LoadCursorW(None, cursor_id): shape for cursor_id, shape in {
+            32512: "default", 32513: "text", 32514: "wait", 32515: "crosshair", 32642: "nwse-resize",
+            32643: "nesw-resize", 32644: "ew-resize", 32645: "ns-resize", 32646: "move", 32648: "not-allowed",
+            32649: "pointer", 32650: "progress",
+        }.items()
+    }
+
+
+def cursor_shape():
+    """Returns the CSS name of the pointer's shape. Only Windows reports it cheaply; elsewhere it is an arrow."""
+    if os.name != "nt":
+        return "default"
+    info = CURSORINFO(cbSize=ctypes.sizeof(CURSORINFO))
+    if not user32.GetCursorInfo(ctypes.byref(info)):
+        return "default"
+    if not info.flags & CURSOR_SHOWING:
+        return "none"
+    return WINDOWS_CURSORS.get(info.hCursor, "default")  # Application cursors look like an arrow
+
+
+def read_cursor():
+    """Returns the pointer's position as fractions of the screen, and its shape."""
+    x, y = pyautogui.position()
+    return x / SCREEN_WIDTH, y / SCREEN_HEIGHT, cursor_shape()
+
+
+async def send_cursor(connection, scheduler):
+    """Sends the pointer's position and shape on the cursor channel whenever they change, while anyone is watching."""
+    loop = asyncio.get_running_loop()
+    sent = None
+    while True:
+        if not scheduler.watched.is_set():
+            await scheduler.watched.wait()
+            sent = None  # Viewers that joined meanwhile have the server's copy, but it may be stale
+        await asyncio.sleep(1 / CURSOR_RATE)
+        # Sampled on the input thread, which owns pyautogui
+        message = protocol.pack_cursor(*await loop.run_in_executor(input_pool, read_cursor))
+        # Skip while an update is still queued; the pointer's newest state goes out once it drains
+        if message == sent or connection.queued_bytes[protocol.CHANNEL_CURSOR]:
+            continue
+        connection.send_nowait(protocol.CHANNEL_CURSOR, message)
+        sent = message
 
 # Audio settings
-AUDIO_CHUNK = 1024  # Audio chunk size
+AUDIO_CHUNK = 1323  # Audio chunk size (30 ms at 44.1 kHz, a multiple of AUDIO_DOWNSAMPLE)
 FORMAT = pyaudio.paInt16  # Audio format
 CHANNELS = 1  # Mono
 RATE = 44100  # Sample rate
+AUDIO_DOWNSAMPLE = 3  # 44.1 kHz -> 14.7 kHz, plenty for voice
+AUDIO_QUEUE_LIMIT = 16  # Packets held while the socket is slow or reconnecting (~0.5 s)
+MULAW_BIAS = 0x84
+MULAW_CLIP = 32635
+
+
+def mulaw_encode(samples):
+    """Compresses 16-bit samples to 8-bit G.711 mu-law codes."""
+    samples = samples.astype(np.int32)
+    sign = (samples < 0).astype(np.uint8) << 7
+    magnitude = np.minimum(np.abs(samples), MULAW_CLIP) + MULAW_BIAS
+    exponent = np.clip(np.floor(np.log2(magnitude)).astype(np.int32) - 7, 0, 7)
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    return (~(sign | (exponent << 4).astype(np.uint8) | mantissa.astype(np.uint8))).astype(np.uint8).tobytes()
+
+
+def encode_audio_chunk(data):
+    """Downsamples a raw 16-bit chunk (averaging acts as a simple low-pass filter) and mu-law encodes it."""
+    samples = np.frombuffer(data, dtype=np.int16)
+    # PortAudio may hand over any number of frames; the last one or two samples of an odd chunk are dropped
+    samples = samples[:len(samples) - len(samples) % AUDIO_DOWNSAMPLE]
+    return mulaw_encode(samples.reshape(-1, AUDIO_DOWNSAMPLE).mean(axis=1))
+
+
+def queue_latest(queue, item):
+    """Adds an item to a bounded asyncio queue, discarding the oldest entry when it is full."""
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(item)
+
+
+audio_packets = None  # (capture time, samples) from the microphone, kept across reconnects
+
+
+def start_audio_capture():
+    """Opens the microphone with a callback that queues compressed packets. Returns a function that closes it."""
+    global audio_packets
+    loop = asyncio.get_running_loop()
+    audio_packets = asyncio.Queue(maxsize=AUDIO_QUEUE_LIMIT)
 
-async def send_audio():
-    """Streams audio from the microphone to the WebSocket server."""
-    URI = f"ws://{BASE_URI}:{VOICE_SENDER_PORT}"
-    print(f"🎤 Connecting to {URI} for Audio Streaming")
+    def on_audio(in_data, frame_count, time_info, status):
+        """Runs on PortAudio's capture thread, so reading the mic never blocks the event loop."""
+        captured_at = time.time()
+        loop.call_soon_threadsafe(queue_latest, audio_packets, (captured_at, encode_audio_chunk(in_data)))
+        return (None, pyaudio.paContinue)
 
     p = pyaudio.PyAudio()
-    stream = p.open(format=FORMAT, channels=CHANNELS,
-                    rate=RATE, input=True,
-                    frames_per_buffer=AUDIO_CHUNK)
+    try:
+        stream = p.open(format=FORMAT, channels=CHANNELS,
+                        rate=RATE, input=True,
+                        frames_per_buffer=AUDIO_CHUNK,
+                        stream_callback=on_audio)
+    except OSError as e:
+        print(f"❌ No microphone available, streaming without audio: {e}")
+        p.terminate()
+        return lambda: None
 
-    while True:  # Keep retrying indefinitely
-        try:
-            websocket = await safe_websocket_connect(URI)
-            if not websocket:
-                print("❌ Failed to connect to WebSocket server for audio streaming. Retrying in 5 seconds...")
-                await asyncio.sleep(5)
-                continue  # Retry connection
+    def close():
+        stream.stop_stream()
+        stream.close()
+        p.terminate()
+    return close
 
-            print("🎤 Streaming audio... Press Ctrl+C to stop.")
-            try:
-                while True:
-                    data = stream.read(AUDIO_CHUNK)  # Read chunk from mic
-                    await websocket.send(data)  # Send audio to server
-            except asyncio.CancelledError:
-                print("🔄 Audio stream task cancelled.")
-                break
-            finally:
-                stream.stop_stream()
-                stream.close()
-                p.terminate()
-
-        except (asyncio.CancelledError, websockets.exceptions.ConnectionClosedError):
-            print("🔄 WebSocket connection for audio was lost, attempting reconnect...")
-            await asyncio.sleep(5)  # Wait before retrying
-        except Exception as e:
-            print(f"❌ Unexpected error in send_audio: {e}")
-            await asyncio.sleep(5)  # Avoid rapid failures
+
+async def send_audio(connection, scheduler):
+    """Streams compressed microphone audio on the audio channel while any viewer is connected."""
+    sample_rate = RATE // AUDIO_DOWNSAMPLE
+    sequence = 0
+    while True:
+        captured_at, samples = await audio_packets.get()
+        if scheduler.viewers == 0:
+            continue  # Nobody to hear it; dropping keeps stale audio from bursting out later
+        await connection.send(protocol.CHANNEL_AUDIO, protocol.pack_audio_packet(
+            protocol.AUDIO_MULAW, CHANNELS, sample_rate, sequence, samples, captured_at
+        ))
+        sequence += 1
 
 
 '''
@@ -223,93 +872,173 @@ ________________________________________________________________________________
 def load_config():
     try:
         # print(f"Fetching config from {WEB_URI}/config")
-        resp = requests.get(f"{WEB_URI}/config").json()
+        resp = requests.get(f"{WEB_URI}/config", timeout=5).json()
         # print(f"Received config: {resp}")
         return resp
     except requests.exceptions.RequestException as e:
         print(f"❌ Error fetching config: {e}")
         return {}
 
-async def restart_websockets():
-    """Cancels existing WebSocket tasks and restarts them with new ports."""
-    global websocket_tasks
 
-    # Cancel existing tasks
-    for task in websocket_tasks:
-        task.cancel()
-    await asyncio.sleep(1)  # Allow cancellation to process
+def apply_config(resp):
+    """Applies config values in place and returns the names of the tasks whose connection changed."""
+    global SCREEN_RESOLUTION_MULTIPLIER, REFRESH_RATE, BASE_URI, MUX_PORT
+    global ADAPTIVE_QUALITY, JPEG_QUALITY, TARGET_LATENCY, BANDWIDTH_BUDGET
+
+    # Picked up by the running capture pipeline on its next frame
+    SCREEN_RESOLUTION_MULTIPLIER = float(resp.get("resolution_multiplier", SCREEN_RESOLUTION_MULTIPLIER))
+    REFRESH_RATE = float(resp.get("refresh_rate", REFRESH_RATE))
+    ADAPTIVE_QUALITY = bool(resp.get("adaptive_quality", ADAPTIVE_QUALITY))
+    JPEG_QUALITY = int(resp.get("max_quality", JPEG_QUALITY))
+    TARGET_LATENCY = float(resp.get("target_latency", TARGET_LATENCY * 1000)) / 1000
+    BANDWIDTH_BUDGET = float(resp.get("bandwidth_budget", BANDWIDTH_BUDGET * 8 / 1000)) * 1000 / 8
+
+    # Only an address change needs a new connection
+    restart = set()
+    new_mux_port = resp.get("mux_port", MUX_PORT)
+    if new_mux_port != MUX_PORT:
+        MUX_PORT = new_mux_port
+        restart.add("stream")
+    new_base_uri = resp.get("server_uri", BASE_URI)
+    if new_base_uri != BASE_URI:
+        BASE_URI = new_base_uri
+        restart.add("stream")
+    return restart
 
-    # Restart WebSocket connections
-    websocket_tasks = [
-        asyncio.create_task(capture_and_send()),
-        asyncio.create_task(receive_mouse_control()),
-        asyncio.create_task(send_audio())
+
+def restart_websockets(names):
+    """Points the named WebSocket tasks at the current settings. A connected task only has its socket
+    closed: it reconnects to the new address and keeps its pipeline. Others are started again."""
+    for name in names:
+        websocket = live_websockets.get(name)
+        if websocket is not None:
+            asyncio.create_task(websocket.close())
+            continue
+        task = websocket_tasks.get(name)
+        if task:
+            task.cancel()
+        websocket_tasks[name] = asyncio.create_task(TASK_FACTORIES[name]())
+    if names:
+        print(f"🔄 WebSocket connections restarted: {', '.join(sorted(names))}")
+
+
+config_version = 0
+
+
+def handle_config(payload):
+    """Applies config pushed by the server as soon as it changes."""
+    global config_version
+    try:
+        update = json.loads(payload)
+        # Each connection starts with a snapshot; later pushes are diffs with increasing versions
+        if not update.get("snapshot") and update["version"] <= config_version:
+            return
+        config_version = update["version"]
+        restart_websockets(apply_config(update["config"]))
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        print(f"❌ Error loading config: {e}")
+
+
+async def route_messages(connection, controller, scheduler, control_messages):
+    """Hands every message from the server to whatever handles its channel."""
+    async for channel, payload in connection.messages():
+        if channel == protocol.CHANNEL_CONTROL:
+            control_messages.put_nowait(payload)
+        elif channel == protocol.CHANNEL_VIDEO:
+            handle_feedback(payload, controller, scheduler)
+        elif channel == protocol.CHANNEL_CONFIG:
+            handle_config(payload)
+
+
+async def run_connection(connection, controller, scheduler, control_messages, pipeline):
+    """Carries a session over one WebSocket until it drops. Raises if a pipeline stage failed instead."""
+    uri = f"ws://{BASE_URI}:{MUX_PORT}/{quote(HOST_ID, safe='')}?role=host&resume={RESUME_TOKEN}"
+    print(f"⚙ Connecting to {uri}")
+    websocket = await safe_websocket_connect(uri)  # Read again on every attempt, so a moved server is followed
+    scheduler.begin_resume()
+    connection.attach(websocket)
+    live_websockets["stream"] = websocket
+    tasks = [
+        asyncio.create_task(connection.run_writer()),
+        asyncio.create_task(route_messages(connection, controller, scheduler, control_messages)),
     ]
-    print("🔄 WebSocket connections restarted.")
+    try:
+        # route_messages returns when the server closes the connection; the others only stop by raising
+        done, _ = await asyncio.wait(tasks + pipeline, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()  # Re-raises whatever stopped it
+        print("🔄 Server closed the connection, resuming...")
+    except (websockets.exceptions.ConnectionClosed, ConnectionError):
+        print("🔄 WebSocket connection lost, resuming...")
+    finally:
+        live_websockets.pop("stream", None)
+        for task in tasks:
+            task.cancel()
+        connection.fail(ConnectionError("Reconnecting"))  # Senders wait for the next socket
+        await websocket.close()
 
 
-async def set_config():
-    """Fetches and updates configuration from the server, restarting WebSockets if necessary."""
-    global SCREEN_RESOLUTION_MULTIPLIER, REFRESH_RATE, CONTROL_SENDER_PORT, IMAGE_RECEIVER_PORT
-    global BASE_URI, LAST_CONTROL_SENDER_PORT, LAST_IMAGE_RECEIVER_PORT, VOICE_SENDER_PORT
-    while True:
-        try:
-            resp = load_config()
-            SCREEN_RESOLUTION_MULTIPLIER = float(resp.get("resolution_multiplier", SCREEN_RESOLUTION_MULTIPLIER))
-            REFRESH_RATE = float(resp.get("refresh_rate", REFRESH_RATE))
-            new_control_sender_port = resp.get("control_sender_port", CONTROL_SENDER_PORT)
-            new_image_receiver_port = resp.get("image_receiver_port", IMAGE_RECEIVER_PORT)
-            new_voice_sender_port = resp.get("voice_sender_port", VOICE_SENDER_PORT)
-            BASE_URI = resp.get("server_uri", BASE_URI)
-
-            # Detect if ports have changed
-            if new_control_sender_port != CONTROL_SENDER_PORT or new_image_receiver_port != IMAGE_RECEIVER_PORT:
-                print("⚠️ Detected port change. Restarting WebSocket connections...")
-                
-                # Update ports
-                CONTROL_SENDER_PORT = new_control_sender_port
-                IMAGE_RECEIVER_PORT = new_image_receiver_port
-                VOICE_SENDER_PORT = new_voice_sender_port
-                
-                # Restart tasks safely
-                await restart_websockets()
+async def stream_session():
+    """Streams the screen and audio and receives control and config over one multiplexed connection.
 
+    The capture pipeline outlives the WebSocket: when it drops, the stages wait and carry on over the
+    next one, so a network blip costs a reconnect rather than a restart of capture and encoding.
+    """
+    while True:  # Keep retrying indefinitely
+        connection = mux.ResumableMuxConnection()
+        controller = AdaptiveController()
+        scheduler = CaptureScheduler()
+        control_messages = asyncio.Queue()
+        pipeline = [
+            asyncio.create_task(capture_and_send(connection, controller, scheduler)),
+            asyncio.create_task(receive_mouse_control(control_messages, scheduler)),
+            asyncio.create_task(send_audio(connection, scheduler)),
+            asyncio.create_task(send_cursor(connection, scheduler)),
+        ]
+        try:
+            while True:
+                await run_connection(connection, controller, scheduler, control_messages, pipeline)
+                await asyncio.sleep(RECONNECT_DELAY)  # In case the server keeps closing right away
         except Exception as e:
-            print(f"❌ Error loading config: {e}")
+            print(f"❌ Unexpected error in stream_session: {e}")
+            await asyncio.sleep(5)  # Avoid rapid failures
+        finally:
+            for task in pipeline:
+                task.cancel()
 
-        await asyncio.sleep(3)  # Refresh config every 3 seconds
 
+TASK_FACTORIES = {
+    "stream": stream_session,
+}
+websocket_tasks = {}
+live_websockets = {}  # Task name -> the WebSocket it is connected over, if any
 
-websocket_tasks = []
-  
 
 async def main():
-    """Runs both screen streaming and mouse control tasks with dynamic reconnections."""
-    global WEB_URI, BASE_URI, WEB_INTERFACE_PORT
+    """Streams the screen and audio and replays control events, reconnecting whenever the server moves."""
+    global WEB_URI, BASE_URI, WEB_INTERFACE_PORT, HOST_ID
     base_ip = input("Enter the server IP: ")
     base_port = input("Enter the server port: ")
+    HOST_ID = input(f"Enter the host ID [{HOST_ID}]: ").strip() or HOST_ID
     WEB_INTERFACE_PORT = base_port
     BASE_URI = base_ip
     WEB_URI = f"http://{base_ip}:{base_port}"
 
-    await set_config()
-    global websocket_tasks
-    websocket_tasks = [
-        asyncio.create_task(capture_and_send()),
-        asyncio.create_task(receive_mouse_control()),
-        asyncio.create_task(send_audio()),
-        asyncio.create_task(set_config())  # Monitors config changes
-    ]
+    # Fetch the initial config once over HTTP; after that changes are pushed over the config channel
+    apply_config(await asyncio.to_thread(load_config))
+    close_audio = start_audio_capture()  # The microphone stays open across reconnects
+    restart_websockets(TASK_FACTORIES)
 
     try:
-        await asyncio.gather(*websocket_tasks)
+        await asyncio.Future()  # Run until interrupted
     except asyncio.CancelledError:
         print("⚠️ Async tasks cancelled. Cleaning up before exiting...")
     finally:
-        for task in websocket_tasks:
+        for task in websocket_tasks.values():
             task.cancel()
         await asyncio.sleep(1)
+        close_audio()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
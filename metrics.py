@@ -0,0 +1,92 @@
+"""Latency histograms for the /metrics route, rendered in the Prometheus text format."""
+import bisect
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Seconds
+BYTE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    """Counts observations into fixed buckets, like a Prometheus histogram."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last bucket is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimates a quantile as the upper bound of the bucket it falls in (None if empty or above the last bound)."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(zip(self.buckets, self.counts)),
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class MetricSet:
+    """Histograms keyed by metric name and labels, e.g. ("trisma_client_stage_seconds", stage="grab")."""
+
+    def __init__(self):
+        self.histograms = {}
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def get(self, name, **labels):
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def entries(self, **labels):
+        """Yields (name, labels, histogram) with the given labels added to every entry."""
+        for (name, own_labels), histogram in list(self.histograms.items()):
+            yield name, dict(labels, **dict(own_labels)), histogram
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def render(entries):
+    """Formats (name, labels, value) entries, where value is a Histogram or a number, as Prometheus text."""
+    families = {}
+    for name, labels, value in entries:
+        families.setdefault(name, []).append((labels, value))
+    lines = []
+    for name, samples in sorted(families.items()):
+        lines.append(f"# TYPE {name} {'histogram' if isinstance(samples[0][1], Histogram) else 'gauge'}")
+        for labels, value in samples:
+            if not isinstance(value, Histogram):
+                lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(value.buckets + ("+Inf",), value.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(dict(labels, le=bound))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {value.sum}")
+            lines.append(f"{name}_count{format_labels(labels)} {value.count}")
+    return "\n".join(lines) + "\n"
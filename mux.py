@@ -0,0 +1,176 @@
+"""Prioritized channel multiplexing over one WebSocket, shared by client.py and server.py."""
+import asyncio
+import collections
+import websockets
+import protocol
+
+
+class MuxConnection:
+    """Carries the control, config, audio and video channels of one peer over a single WebSocket.
+
+    Messages are cut into fragments (see protocol.mux_fragments) and the writer always sends the
+    next fragment of the highest-priority channel that has data waiting, so a click never waits
+    behind more than one fragment of a video frame.
+    """
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.queues = {channel: collections.deque() for channel in protocol.CHANNEL_PRIORITY}
+        self.queued_bytes = dict.fromkeys(protocol.CHANNEL_PRIORITY, 0)
+        self.ready = asyncio.Event()
+        self.assembler = protocol.MuxAssembler()
+        self.error = None  # Set once the writer has stopped; later sends fail with it
+
+    def send_nowait(self, channel, payload, done=None):
+        """Queues a message without waiting for it to be written."""
+        if self.error is not None:
+            if done is not None:
+                done.set_exception(self.error)
+            return
+        self.queues[channel].append((protocol.mux_fragments(channel, payload), len(payload), done))
+        self.queued_bytes[channel] += len(payload)
+        self.ready.set()
+
+    async def send(self, channel, payload):
+        """Queues a message and waits until its last fragment has been handed to the socket."""
+        done = asyncio.get_running_loop().create_future()
+        self.send_nowait(channel, payload, done)
+        await done
+
+    def buffered(self, channel=None):
+        """Returns the bytes waiting on a channel (or on all of them), plus the socket's write buffer."""
+        queued = sum(self.queued_bytes.values()) if channel is None else self.queued_bytes[channel]
+        transport = self.websocket.transport
+        return queued + (transport.get_write_buffer_size() if transport else 0)
+
+    def channel(self, channel):
+        return MuxLink(self, channel)
+
+    def next_channel(self):
+        return next((channel for channel in protocol.CHANNEL_PRIORITY if self.queues[channel]), None)
+
+    async def run_writer(self):
+        """Writes queued fragments, highest-priority channel first, until the connection closes."""
+        try:
+            while True:
+                channel = self.next_channel()
+                if channel is None:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+                fragments, size, done = self.queues[channel][0]
+                fragment = next(fragments, None)
+                if fragment is None:
+                    self.queues[channel].popleft()
+                    self.queued_bytes[channel] -= size
+                    if done is not None and not done.done():
+                        done.set_result(None)
+                    continue
+                await self.websocket.send(fragment)
+        except websockets.exceptions.ConnectionClosed as e:
+            self.fail(e)
+            raise
+        finally:
+            self.fail(ConnectionError("Multiplexed connection closed"))
+
+    def abort(self):
+        """Drops the connection at once, without waiting for a closing handshake the peer may never answer."""
+        transport = self.websocket.transport
+        if transport is not None:
+            transport.abort()
+
+    def fail(self, error):
+        """Fails every waiting sender once the connection can no longer be written."""
+        if self.error is None:
+            self.error = error
+        for queue in self.queues.values():
+            while queue:
+                _, _, done = queue.popleft()
+                if done is not None and not done.done():
+                    done.set_exception(self.error)
+        self.queued_bytes = dict.fromkeys(protocol.CHANNEL_PRIORITY, 0)
+
+    async def messages(self):
+        """Yields (channel, payload) for every complete message received."""
+        async for fragment in self.websocket:
+            if isinstance(fragment, str):
+                continue  # Multiplexed peers only send binary fragments
+            message = self.assembler.feed(fragment)
+            if message is not None:
+                yield message
+
+
+class ResumableMuxConnection(MuxConnection):
+    """A MuxConnection that outlives its WebSocket. While the peer reconnects, send() waits instead of
+    failing, and a message cut off by the dropped socket is sent again whole over the next one."""
+
+    def __init__(self):
+        super().__init__(None)
+        self.error = ConnectionError("Not connected yet")  # send_nowait() drops messages while detached
+        self.attached = asyncio.Event()
+
+    def attach(self, websocket):
+        """Carries on over a new WebSocket; run its writer with run_writer()."""
+        self.websocket = websocket
+        self.assembler = protocol.MuxAssembler()
+        self.error = None
+        self.attached.set()
+
+    def fail(self, error):
+        self.attached.clear()  # Before the waiting senders wake up, so they wait for the next socket
+        super().fail(error)
+
+    async def send(self, channel, payload):
+        while True:
+            await self.attached.wait()
+            try:
+                return await super().send(channel, payload)
+            except (websockets.exceptions.ConnectionClosed, ConnectionError):
+                continue
+
+    def buffered(self, channel=None):
+        if self.websocket is None:
+            return 0
+        return super().buffered(channel)
+
+
+class SocketLink:
+    """A whole WebSocket carrying one kind of traffic, as on the legacy one-port-per-channel servers."""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+
+    @property
+    def remote_address(self):
+        return self.websocket.remote_address
+
+    async def send(self, message):
+        await self.websocket.send(message)
+
+    def send_nowait(self, message):
+        websockets.broadcast([self.websocket], message)
+
+    def buffered(self):
+        transport = self.websocket.transport
+        return transport.get_write_buffer_size() if transport else 0
+
+
+class MuxLink:
+    """One channel of a MuxConnection, interchangeable with a SocketLink."""
+
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.channel = channel
+
+    @property
+    def remote_address(self):
+        return self.connection.websocket.remote_address
+
+    async def send(self, message):
+        await self.connection.send(self.channel, message.encode() if isinstance(message, str) else message)
+
+    def send_nowait(self, message):
+        self.connection.send_nowait(self.channel, message.encode() if isinstance(message, str) else message)
+
+    def buffered(self):
+        return self.connection.buffered(self.channel)
@@ -0,0 +1,291 @@
+"""Binary frame, control, audio and multiplexing formats shared by client.py, server.py and templates/index.html."""
+import json
+import struct
+import time
+from collections import namedtuple
+
+FRAME_VERSION = 1
+
+# Frame kinds
+FRAME_FULL = 0   # Payload is one image of the whole screen
+FRAME_TILES = 1  # Payload is a list of image tiles to patch onto the current frame
+FRAME_COPY = 2   # Payload moves regions of the current frame (e.g. a scroll), then patches tiles as FRAME_TILES does
+
+# Image codecs
+CODEC_JPEG = 0
+CODEC_WEBP = 1
+CODEC_PNG = 2
+CODEC_RAW = 3  # Packed 24-bit RGB rows
+CODEC_FORMATS = {CODEC_JPEG: "JPEG", CODEC_WEBP: "WEBP", CODEC_PNG: "PNG"}  # Pillow format names
+
+# Flags
+FLAG_DEFLATE = 0x01  # Every image payload is zlib-compressed on top of its codec
+RENDITION_SHIFT = 4  # Bits 4-5 hold the frame's rendition, an index into RENDITION_SCALES
+
+# Renditions: the host can stream the screen at several sizes at once, each viewer watching the one that suits it.
+# Each is its own stream of keyframes and deltas; all share the sequence numbers of the captures they come from.
+RENDITION_SCALES = (1, 2, 4)  # Divisor of the streaming resolution
+
+FRAME_HEADER = struct.Struct("!BBBBHHId")  # version, kind, codec, flags, width, height, sequence, capture time
+TILE_COUNT = struct.Struct("!H")           # number of tiles in a FRAME_TILES payload
+TILE_HEADER = struct.Struct("!HHHHI")      # x, y, width, height, image length
+COPY_COUNT = struct.Struct("!H")           # number of copies in a FRAME_COPY payload, which precede its tiles
+COPY_RECT = struct.Struct("!HHHHHH")       # source x, source y, width, height, destination x, destination y
+
+FrameHeader = namedtuple("FrameHeader", "version kind codec flags width height sequence timestamp")
+
+
+def make_header(codec, width, height, sequence, flags=0, timestamp=None):
+    """Builds a frame header stamped with the current time unless a timestamp is given."""
+    if timestamp is None:
+        timestamp = time.time()
+    return FrameHeader(FRAME_VERSION, FRAME_FULL, codec, flags, width, height, sequence & 0xFFFFFFFF, timestamp)
+
+
+def rendition_flags(rendition):
+    return rendition << RENDITION_SHIFT
+
+
+def frame_rendition(header):
+    """Returns the rendition a frame belongs to (0, the full size, for hosts that send only one)."""
+    return header.flags >> RENDITION_SHIFT & 0x03
+
+
+def pack_full_frame(header, image):
+    """Builds a full-frame message around one encoded image."""
+    return FRAME_HEADER.pack(*header._replace(kind=FRAME_FULL)) + image
+
+
+def tile_parts(tiles):
+    """Returns the tile count and tiles of a delta payload as a list of byte strings."""
+    tiles = list(tiles)
+    parts = [TILE_COUNT.pack(len(tiles))]
+    for x, y, w, h, image in tiles:
+        parts.append(TILE_HEADER.pack(x, y, w, h, len(image)))
+        parts.append(bytes(image))
+    return parts
+
+
+def pack_tile_frame(header, tiles):
+    """Builds a delta message from (x, y, w, h, image) tuples."""
+    return b"".join([FRAME_HEADER.pack(*header._replace(kind=FRAME_TILES))] + tile_parts(tiles))
+
+
+def pack_copy_frame(header, copies, tiles):
+    """Builds a delta message that moves (sx, sy, w, h, dx, dy) regions of the current frame, in order,
+    and then patches (x, y, w, h, image) tiles onto the result."""
+    copies = list(copies)
+    parts = [FRAME_HEADER.pack(*header._replace(kind=FRAME_COPY)), COPY_COUNT.pack(len(copies))]
+    parts.extend(COPY_RECT.pack(*copy) for copy in copies)
+    return b"".join(parts + tile_parts(tiles))
+
+
+def unpack_header(message):
+    """Parses the header of a frame message, rejecting versions this module does not know."""
+    header = FrameHeader._make(FRAME_HEADER.unpack_from(message))
+    if header.version != FRAME_VERSION:
+        raise ValueError(f"Unsupported frame version {header.version}")
+    return header
+
+
+def iter_copies(message):
+    """Yields (sx, sy, w, h, dx, dy) for every copy in a delta message (none unless it is a FRAME_COPY)."""
+    if message[1] != FRAME_COPY:
+        return
+    (count,) = COPY_COUNT.unpack_from(message, FRAME_HEADER.size)
+    yield from COPY_RECT.iter_unpack(memoryview(message)[FRAME_HEADER.size + COPY_COUNT.size:][:count * COPY_RECT.size])
+
+
+def iter_tiles(message):
+    """Yields (x, y, w, h, image) for every tile in a delta message."""
+    view = memoryview(message)
+    offset = FRAME_HEADER.size
+    if message[1] == FRAME_COPY:
+        (count,) = COPY_COUNT.unpack_from(view, offset)
+        offset += COPY_COUNT.size + count * COPY_RECT.size
+    (count,) = TILE_COUNT.unpack_from(view, offset)
+    offset += TILE_COUNT.size
+    for _ in range(count):
+        x, y, w, h, length = TILE_HEADER.unpack_from(view, offset)
+        offset += TILE_HEADER.size
+        yield x, y, w, h, view[offset:offset + length]
+        offset += length
+
+
+# Audio packets
+AUDIO_VERSION = 1
+AUDIO_PCM16 = 0  # Signed 16-bit big-endian samples
+AUDIO_MULAW = 1  # 8-bit G.711 mu-law samples
+AUDIO_HEADER = struct.Struct("!BBBxIId")  # version, codec, channels, sample rate, sequence, capture time
+
+
+def pack_audio_packet(codec, channels, sample_rate, sequence, samples, timestamp=None):
+    """Builds an audio packet around encoded samples."""
+    if timestamp is None:
+        timestamp = time.time()
+    return AUDIO_HEADER.pack(AUDIO_VERSION, codec, channels, sample_rate, sequence & 0xFFFFFFFF, timestamp) + samples
+
+
+# Control events
+#
+# A binary control message is a version byte followed by one or more fixed-size events.
+# Coordinates are fractions of the screen in 16-bit fixed point. Keys are Unicode code points
+# for printable characters or NAMED_KEY_BASE + index into NAMED_KEYS. Events that do not fit
+# (e.g. an unknown named key) are sent as JSON instead, which every peer still accepts.
+CONTROL_VERSION = 1
+CONTROL_EVENT = struct.Struct("!BHHBI")  # opcode, x, y, button, key code
+CONTROL_ACTIONS = ["", "move", "mousedown", "mouseup", "keydown", "keyup", "click", "dblclick", "rightclick"]
+CONTROL_OPCODES = {action: opcode for opcode, action in enumerate(CONTROL_ACTIONS) if action}
+FIXED_POINT_SCALE = 0xFFFF
+NAMED_KEY_BASE = 0x110000  # First value above the Unicode range
+NAMED_KEYS = [
+    "Control", "Shift", "Alt", "Meta", "Enter", "Backspace", "Tab", "Escape",
+    "ArrowUp", "ArrowDown", "ArrowLeft", "ArrowRight", "Delete", "Home", "End", "PageUp",
+    "PageDown", "Insert", "CapsLock", "ContextMenu", "F1", "F2", "F3", "F4",
+    "F5", "F6", "F7", "F8", "F9", "F10", "F11", "F12",
+]
+NAMED_KEY_CODES = {name: NAMED_KEY_BASE + index for index, name in enumerate(NAMED_KEYS)}
+
+
+def encode_key(key):
+    """Returns the key code for a browser key name, or None if it has none."""
+    if not key:
+        return 0
+    if len(key) == 1:
+        return ord(key)
+    return NAMED_KEY_CODES.get(key)
+
+
+def decode_key(code):
+    if code == 0:
+        return ""
+    if code >= NAMED_KEY_BASE:
+        return NAMED_KEYS[code - NAMED_KEY_BASE]
+    return chr(code)
+
+
+def to_fixed_point(value):
+    return min(FIXED_POINT_SCALE, max(0, round(float(value) * FIXED_POINT_SCALE)))
+
+
+def encode_control_events(events):
+    """Packs control event dicts into one binary message, or returns None if any of them cannot be packed."""
+    parts = [bytes([CONTROL_VERSION])]
+    for event in events:
+        opcode = CONTROL_OPCODES.get(event.get("action"))
+        key = encode_key(event.get("key", ""))
+        button = event.get("button", 0)
+        if opcode is None or key is None or button not in (0, 1, 2):
+            return None
+        parts.append(CONTROL_EVENT.pack(opcode, to_fixed_point(event.get("x", 0)), to_fixed_point(event.get("y", 0)), button, key))
+    return b"".join(parts)
+
+
+def decode_control_events(message):
+    """Unpacks a binary control message into event dicts shaped like the JSON ones."""
+    if not message or message[0] != CONTROL_VERSION:
+        raise ValueError(f"Unsupported control version {message[0] if message else None}")
+    events = []
+    for opcode, x, y, button, key in CONTROL_EVENT.iter_unpack(memoryview(message)[1:]):
+        if not 0 < opcode < len(CONTROL_ACTIONS):
+            raise ValueError(f"Unknown control opcode {opcode}")
+        events.append({
+            "action": CONTROL_ACTIONS[opcode],
+            "x": x / FIXED_POINT_SCALE,
+            "y": y / FIXED_POINT_SCALE,
+            "button": button,
+            "key": decode_key(key),
+        })
+    return events
+
+
+def parse_control_message(message):
+    """Decodes a binary or JSON control message into a list of event dicts."""
+    if isinstance(message, (bytes, bytearray, memoryview)) and bytes(message[:1]) not in (b"[", b"{"):
+        return decode_control_events(message)
+    events = json.loads(message)
+    return events if isinstance(events, list) else [events]
+
+
+# Cursor updates
+#
+# The host samples its pointer on its own, far more often than it captures frames, and sends the
+# position (fractions of the screen in 16-bit fixed point, like control events) and shape. Shapes
+# are CSS cursor names, so the page can mirror them.
+CURSOR_VERSION = 1
+CURSOR_UPDATE = struct.Struct("!BHHB")  # version, x, y, shape
+CURSOR_SHAPES = [
+    "none", "default", "text", "pointer", "wait", "progress", "crosshair", "move",
+    "ns-resize", "ew-resize", "nwse-resize", "nesw-resize", "not-allowed",
+]
+CURSOR_SHAPE_CODES = {shape: code for code, shape in enumerate(CURSOR_SHAPES)}
+
+
+def pack_cursor(x, y, shape="default"):
+    """Builds a cursor update from screen fractions and a CSS cursor name."""
+    return CURSOR_UPDATE.pack(CURSOR_VERSION, to_fixed_point(x), to_fixed_point(y), CURSOR_SHAPE_CODES.get(shape, 1))
+
+
+def unpack_cursor(message):
+    """Returns (x, y, shape) from a cursor update, with x and y as screen fractions."""
+    version, x, y, shape = CURSOR_UPDATE.unpack(message)
+    if version != CURSOR_VERSION:
+        raise ValueError(f"Unsupported cursor version {version}")
+    if shape >= len(CURSOR_SHAPES):
+        raise ValueError(f"Unknown cursor shape {shape}")
+    return x / FIXED_POINT_SCALE, y / FIXED_POINT_SCALE, CURSOR_SHAPES[shape]
+
+
+# Multiplexed connections
+#
+# Every WebSocket message on a multiplexed connection is one fragment: a byte holding the channel
+# ID, with MUX_MORE set if further fragments of the same message follow, then up to
+# MUX_FRAGMENT_SIZE bytes of payload. Fragments of different channels may interleave, which lets
+# a control event overtake a large video frame. Text payloads (JSON) are sent as UTF-8.
+CHANNEL_CONTROL = 1
+CHANNEL_CONFIG = 2
+CHANNEL_AUDIO = 3
+CHANNEL_VIDEO = 4  # Frames one way; viewer acknowledgements and host feedback the other
+CHANNEL_METRICS = 5  # Per-frame stage timings reported by the host
+CHANNEL_CURSOR = 6  # Pointer position and shape, from the host to viewers
+CHANNEL_PRIORITY = (CHANNEL_CONTROL, CHANNEL_CURSOR, CHANNEL_CONFIG, CHANNEL_AUDIO, CHANNEL_METRICS, CHANNEL_VIDEO)  # Highest first
+MUX_MORE = 0x80
+MUX_FRAGMENT_SIZE = 16 * 1024
+MUX_MAX_MESSAGE = 64 * 1024 * 1024
+
+
+def mux_fragments(channel, payload):
+    """Yields the fragments that carry one message on a channel."""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    view = memoryview(payload)
+    for offset in range(0, max(len(view), 1), MUX_FRAGMENT_SIZE):
+        chunk = view[offset:offset + MUX_FRAGMENT_SIZE]
+        more = offset + MUX_FRAGMENT_SIZE < len(view)
+        yield b"".join((bytes([channel | (MUX_MORE if more else 0)]), chunk))
+
+
+class MuxAssembler:
+    """Reassembles fragments into complete (channel, payload) messages."""
+
+    def __init__(self):
+        self.partial = {}  # Channel -> bytearray of the message being received
+
+    def feed(self, fragment):
+        """Takes one fragment and returns (channel, payload) when it completes a message, else None."""
+        if not fragment:
+            raise ValueError("Empty multiplexed fragment")
+        channel = fragment[0] & ~MUX_MORE
+        data = memoryview(fragment)[1:]
+        if fragment[0] & MUX_MORE:
+            buffer = self.partial.setdefault(channel, bytearray())
+            if len(buffer) + len(data) > MUX_MAX_MESSAGE:
+                del self.partial[channel]
+                raise ValueError(f"Message on channel {channel} exceeds {MUX_MAX_MESSAGE} bytes")
+            buffer += data
+            return None
+        if channel in self.partial:
+            buffer = self.partial.pop(channel)
+            buffer += data
+            return channel, bytes(buffer)
+        return channel, bytes(data)
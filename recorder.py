@@ -0,0 +1,293 @@
+"""Optional on-disk recording of host sessions for server.py, and replay of the recordings to viewers.
+
+Each host's full-size frames go to <directory>/<host ID>/ as a series of segments. Every segment starts
+with a keyframe and comes with an index of its keyframes, so a replay can start anywhere:
+
+    <start ms>.trec  one record per frame: RECORD_HEADER (arrival time, length), then the frame message
+    <start ms>.tidx  one INDEX_ENTRY (arrival time, record offset) per keyframe in the segment
+
+Frames are batched in memory and written by a single background thread, so the relay's event loop never
+waits for the disk. A segment is closed at the first keyframe after it reaches the size limit.
+"""
+import asyncio
+import mmap
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote
+
+import protocol
+
+SEGMENT_BYTES = 256 * 1024 * 1024  # Size after which the next keyframe starts a new segment
+FLUSH_INTERVAL = 0.5  # Seconds between batched writes
+BACKLOG_LIMIT = 64 * 1024 * 1024  # Bytes waiting for the disk before deltas are dropped until the next keyframe
+REPLAY_BATCH_BYTES = 4 * 1024 * 1024  # Read from the recording per trip to the reader thread
+REPLAY_PREFIX = "replay-"  # Session IDs of replays, which only carry the full-size rendition
+MAX_REPLAY_SPEED = 64
+
+RECORD_HEADER = struct.Struct("!dI")  # arrival time, message length
+INDEX_ENTRY = struct.Struct("!dQ")  # arrival time, offset of the keyframe's record
+SEGMENT_SUFFIX = ".trec"
+INDEX_SUFFIX = ".tidx"
+
+
+class Track:
+    """The recorder's event-loop-side state for one host."""
+
+    def __init__(self):
+        self.segment = None  # Name of the segment being written, None until the first keyframe
+        self.size = 0  # Bytes queued for the segment so far
+        self.skipping = False  # Deltas are dropped until the next keyframe after the backlog overflowed
+        self.keyframe_requested = False
+
+
+class Recorder:
+    """Records the frames of every session under one directory."""
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.tracks = {}  # Host ID -> Track
+        self.pending = []  # (host ID, segment, is keyframe, arrival time, message) not yet handed to the writer
+        self.backlog = 0  # Bytes queued or being written
+        self.dropped = 0
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recorder")
+        self.files = {}  # Host ID -> (segment, data file, index file); only used on the writer thread
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, host_id, header, message, arrival=None):
+        """Queues a frame for writing. Returns True when the host should be asked for a keyframe, to start
+        a new segment or to recover from dropped frames."""
+        if protocol.frame_rendition(header) != 0:
+            return False  # Only the full size is kept
+        track = self.tracks.get(host_id)
+        if track is None:
+            track = self.tracks[host_id] = Track()
+        arrival = arrival or time.time()
+        keyframe = header.kind == protocol.FRAME_FULL
+        if keyframe:
+            if self.backlog > BACKLOG_LIMIT:
+                track.skipping = True
+            else:
+                track.skipping = False
+                track.keyframe_requested = False
+                if track.segment is None or track.size >= self.segment_bytes:
+                    track.segment = f"{int(arrival * 1000)}"
+                    track.size = 0
+        elif track.segment is not None and self.backlog > BACKLOG_LIMIT:
+            track.skipping = True
+        if track.segment is None or track.skipping:
+            self.dropped += 1
+            return self.wants_keyframe(track)
+        self.pending.append((host_id, track.segment, keyframe, arrival, message))
+        size = RECORD_HEADER.size + len(message)
+        track.size += size
+        self.backlog += size
+        return track.size >= self.segment_bytes and self.wants_keyframe(track)
+
+    def wants_keyframe(self, track):
+        """Asks for one keyframe at a time, however many frames arrive before it."""
+        if track.keyframe_requested:
+            return False
+        track.keyframe_requested = True
+        return True
+
+    async def run(self):
+        """Hands the queued frames to the writer thread every FLUSH_INTERVAL seconds."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            if not self.pending:
+                continue
+            batch, self.pending = self.pending, []
+            try:
+                written = await loop.run_in_executor(self.writer, self.write_batch, batch)
+            finally:
+                self.backlog -= sum(RECORD_HEADER.size + len(message) for *_, message in batch)
+            if written < len(batch):
+                self.dropped += len(batch) - written
+
+    def write_batch(self, batch):
+        """Appends frames to their segments. Runs on the writer thread. Returns how many were written."""
+        written = 0
+        touched = set()
+        for host_id, segment, keyframe, arrival, message in batch:
+            try:
+                data, index = self.segment_files(host_id, segment)
+                if keyframe:
+                    index.write(INDEX_ENTRY.pack(arrival, data.tell()))
+                data.write(RECORD_HEADER.pack(arrival, len(message)))
+                data.write(message)
+                touched.add(host_id)
+                written += 1
+            except OSError as e:
+                print(f"❌ Recording {host_id} failed: {e}")
+        for host_id in touched:
+            try:
+                for file in self.files[host_id][1:]:
+                    file.flush()
+            except OSError as e:
+                print(f"❌ Recording {host_id} failed: {e}")
+        return written
+
+    def segment_files(self, host_id, segment):
+        """Returns the open data and index files of a segment, closing the host's previous segment."""
+        current = self.files.get(host_id)
+        if current is not None and current[0] == segment:
+            return current[1:]
+        if current is not None:
+            for file in current[1:]:
+                file.close()
+        folder = os.path.join(self.directory, quote(host_id, safe=""))
+        os.makedirs(folder, exist_ok=True)
+        data = open(os.path.join(folder, segment + SEGMENT_SUFFIX), "ab")
+        index = open(os.path.join(folder, segment + INDEX_SUFFIX), "ab")
+        self.files[host_id] = (segment, data, index)
+        print(f"💾 Recording {host_id} to segment {segment}")
+        return data, index
+
+    def close(self):
+        """Writes whatever is still queued and closes the files. Called on exit."""
+        if self.writer is None:
+            return
+        self.writer.shutdown()  # Lets the batch in flight finish first
+        self.writer = None
+        batch, self.pending = self.pending, []
+        self.write_batch(batch)
+        self.close_files()
+
+    def close_files(self):
+        for _, data, index in self.files.values():
+            data.close()
+            index.close()
+        self.files = {}
+
+    def hosts(self):
+        """Returns the IDs of the hosts that have recordings."""
+        try:
+            names = sorted(os.listdir(self.directory))
+        except OSError:
+            return []
+        return [unquote(name) for name in names if os.path.isdir(os.path.join(self.directory, name))]
+
+    def open(self, host_id):
+        """Returns the Recording of a host, or None if it has none."""
+        recording = Recording(os.path.join(self.directory, quote(host_id, safe="")), host_id)
+        return recording if recording.segments else None
+
+
+class Recording:
+    """Reads one host's segments through memory maps, for seeking and replay."""
+
+    def __init__(self, folder, host_id):
+        self.folder = folder
+        self.host_id = host_id
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            names = []
+        # Segment names are their start times in milliseconds, so numeric order is time order
+        self.segments = sorted((name[:-len(SEGMENT_SUFFIX)] for name in names if name.endswith(SEGMENT_SUFFIX)), key=int)
+
+    def path(self, segment, suffix):
+        return os.path.join(self.folder, segment + suffix)
+
+    def map(self, path):
+        """Maps a file read-only; None if it is empty or missing. Maps reflect what was on disk when made."""
+        try:
+            with open(path, "rb") as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    return None
+                return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            return None
+
+    def keyframes(self, segment):
+        """Returns (arrival time, offset) of every keyframe in a segment."""
+        index = self.map(self.path(segment, INDEX_SUFFIX))
+        if index is None:
+            return []
+        with index:
+            usable = len(index) - len(index) % INDEX_ENTRY.size  # The writer may be midway through an entry
+            return list(INDEX_ENTRY.iter_unpack(index[:usable]))
+
+    def summary(self):
+        """Returns the recording's time span and size."""
+        first = self.keyframes(self.segments[0])
+        last_path = self.path(self.segments[-1], SEGMENT_SUFFIX)
+        size = 0
+        for segment in self.segments:
+            try:
+                size += os.path.getsize(self.path(segment, SEGMENT_SUFFIX))
+            except OSError:
+                pass
+        try:
+            end = os.path.getmtime(last_path)
+        except OSError:
+            end = None
+        return {
+            "host_id": self.host_id,
+            "start": first[0][0] if first else int(self.segments[0]) / 1000,
+            "end": end,
+            "segments": len(self.segments),
+            "bytes": size,
+        }
+
+    def seek(self, at=None):
+        """Returns the (segment number, offset) of the last keyframe at or before a time, or of the first
+        keyframe if the time is earlier or not given."""
+        if at is None:
+            return 0, 0
+        # The last segment that started by then, found from the names; then its index
+        number = 0
+        for candidate, segment in enumerate(self.segments):
+            if int(segment) / 1000 <= at:
+                number = candidate
+        offset = 0
+        for arrival, keyframe_offset in self.keyframes(self.segments[number]):
+            if arrival > at:
+                break
+            offset = keyframe_offset
+        return number, offset
+
+    def read(self, position, limit=REPLAY_BATCH_BYTES):
+        """Returns the (arrival time, message) records from a position on, up to about limit bytes, and the
+        position after them (None at the end of the recording). Runs off the event loop."""
+        number, offset = position
+        frames = []
+        size = 0
+        while number < len(self.segments) and size < limit:
+            data = self.map(self.path(self.segments[number], SEGMENT_SUFFIX))
+            if data is not None:
+                with data:
+                    while offset + RECORD_HEADER.size <= len(data) and size < limit:
+                        arrival, length = RECORD_HEADER.unpack_from(data, offset)
+                        end = offset + RECORD_HEADER.size + length
+                        if end > len(data):
+                            break  # Still being written
+                        frames.append((arrival, data[offset + RECORD_HEADER.size:end]))
+                        size += length
+                        offset = end
+                    if size >= limit:
+                        return frames, (number, offset)
+            number, offset = number + 1, 0
+        return frames, None
+
+    async def play(self, start=None, speed=1.0):
+        """Yields the recorded frame messages from the keyframe before start, paced like the original at
+        the given speed. Frames between that keyframe and start are yielded at once, to catch up."""
+        loop = asyncio.get_running_loop()
+        speed = min(max(float(speed), 0.1), MAX_REPLAY_SPEED)
+        position = self.seek(start)
+        origin = None  # (recorded time, wall time) pacing starts from
+        while position is not None:
+            frames, position = await loop.run_in_executor(None, self.read, position)
+            for arrival, message in frames:
+                if start is None or arrival >= start:
+                    if origin is None:
+                        origin = (arrival, time.monotonic())
+                    delay = origin[1] + (arrival - origin[0]) / speed - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                yield message
@@ -0,0 +1,338 @@
+"""Multi-process viewer fan-out for server.py.
+
+The main process keeps the host connections. Every frame, audio packet, cursor update and config
+push it relays is written once into a shared-memory ring, and relay worker processes, all
+listening on the relay port through SO_REUSEPORT, serve their share of the viewers from it with
+the ordinary mux handler. What viewers send back (control events, acknowledgements, audio) goes to the main
+process over one pipe per worker, so one host's fan-out is no longer limited to one core.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import struct
+import time
+from multiprocessing import shared_memory
+
+RING_BYTES = 64 * 1024 * 1024
+RING_SLOTS = 4096  # Records that can be looked up; older ones count as missed
+
+# Record kinds
+RECORD_FRAME = 1
+RECORD_AUDIO = 2
+RECORD_CONFIG = 3  # A pushed config change, for every session
+RECORD_CURSOR = 4
+
+# Ring layout: header, slot table, then the data area. Positions are absolute byte counts since
+# the ring was created; a record never wraps, it starts over at the beginning of the data area.
+RING_HEADER = struct.Struct("!QQ")  # records written, end of the newest reserved record
+RING_SLOT = struct.Struct("!QQI")   # record number, start position, length
+RECORD_HEADER = struct.Struct("!BBQ")  # kind, host ID length, origin (the relay link that sent it, or 0)
+
+
+class RingWriter:
+    """Appends records to a shared-memory ring. Only the main process's event loop writes."""
+
+    def __init__(self, capacity=RING_BYTES, slots=RING_SLOTS):
+        self.capacity = capacity
+        self.slots = slots
+        self.data_offset = RING_HEADER.size + slots * RING_SLOT.size
+        self.shm = shared_memory.SharedMemory(create=True, size=self.data_offset + capacity)
+        self.buffer = self.shm.buf
+        self.count = 0
+        self.reserved = 0
+        RING_HEADER.pack_into(self.buffer, 0, 0, 0)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, kind, host_id, payload, origin=0):
+        """Appends one record. Returns False if it is too large for the ring."""
+        name = host_id.encode()[:255]
+        length = RECORD_HEADER.size + len(name) + len(payload)
+        if length > self.capacity // 2:
+            print(f"⚠️ Relay record of {length} bytes does not fit the ring, dropping it")
+            return False
+        start = self.reserved
+        offset = start % self.capacity
+        if offset + length > self.capacity:
+            start += self.capacity - offset
+            offset = 0
+        # Reserve first: a reader that is still copying the old bytes here sees it was overwritten
+        RING_HEADER.pack_into(self.buffer, 0, self.count, start + length)
+        position = self.data_offset + offset
+        RECORD_HEADER.pack_into(self.buffer, position, kind, len(name), origin)
+        position += RECORD_HEADER.size
+        self.buffer[position:position + len(name)] = name
+        position += len(name)
+        self.buffer[position:position + len(payload)] = payload
+        RING_SLOT.pack_into(self.buffer, RING_HEADER.size + self.count % self.slots * RING_SLOT.size, self.count, start, length)
+        self.count += 1
+        self.reserved = start + length
+        RING_HEADER.pack_into(self.buffer, 0, self.count, self.reserved)
+        return True
+
+    def close(self):
+        self.buffer.release()
+        self.shm.close()
+        self.shm.unlink()
+
+
+class RingReader:
+    """Reads the records appended since the last call, in order, from a worker process."""
+
+    def __init__(self, name, start, capacity=RING_BYTES, slots=RING_SLOTS):
+        # The ring is created before the workers are spawned, so they share the main process's
+        # resource tracker and attaching here never makes a worker unlink it on exit
+        self.shm = shared_memory.SharedMemory(name=name)
+        self.buffer = self.shm.buf
+        self.capacity = capacity
+        self.slots = slots
+        self.data_offset = RING_HEADER.size + slots * RING_SLOT.size
+        self.next = start
+        self.missed = 0  # Records overwritten before this reader got to them
+
+    def read(self):
+        """Returns (kind, host_id, origin, payload) for every new record that is still intact."""
+        count, _ = RING_HEADER.unpack_from(self.buffer, 0)
+        if count - self.next > self.slots:
+            self.missed += count - self.slots - self.next
+            self.next = count - self.slots
+        records = []
+        while self.next < count:
+            number = self.next
+            self.next += 1
+            slot_offset = RING_HEADER.size + number % self.slots * RING_SLOT.size
+            slot_number, start, length = RING_SLOT.unpack_from(self.buffer, slot_offset)
+            if slot_number != number:
+                self.missed += 1
+                continue
+            position = self.data_offset + start % self.capacity
+            kind, name_length, origin = RECORD_HEADER.unpack_from(self.buffer, position)
+            name_start = position + RECORD_HEADER.size
+            payload_start = name_start + name_length
+            # One copy per worker; every viewer of this worker then shares it
+            host_id = bytes(self.buffer[name_start:payload_start])
+            payload = bytes(self.buffer[payload_start:position + length])
+            _, reserved = RING_HEADER.unpack_from(self.buffer, 0)
+            if reserved > start + self.capacity or RING_SLOT.unpack_from(self.buffer, slot_offset)[0] != number:
+                self.missed += 1  # The writer lapped this reader while it was copying
+                continue
+            records.append((kind, host_id.decode(errors="replace"), origin, payload))
+        return records
+
+    def close(self):
+        self.buffer.release()
+        self.shm.close()
+
+
+class RelayPool:
+    """Runs the relay workers from the main process: writes the ring, wakes the workers and
+    applies what their viewers send back."""
+
+    def __init__(self, server, workers, port):
+        self.server = server
+        self.workers = workers
+        self.port = port
+        self.ring = None
+        self.processes = []
+        self.wakes = []  # Main-process ends of the wake-up pipes
+        self.upstreams = []  # Main-process ends of the pipes workers report through
+
+    def start(self, loop, config_snapshot):
+        self.ring = RingWriter()
+        context = multiprocessing.get_context("spawn")  # Forking a running event loop is unsafe
+        for index in range(self.workers):
+            wake_reader, wake_writer = context.Pipe(duplex=False)
+            upstream_reader, upstream_writer = context.Pipe(duplex=False)
+            process = context.Process(
+                target=worker_main, name=f"relay-{index}", daemon=True,
+                args=(index, self.ring.name, self.ring.count, self.port, config_snapshot, wake_reader, upstream_writer),
+            )
+            process.start()
+            wake_reader.close()
+            upstream_writer.close()
+            os.set_blocking(wake_writer.fileno(), False)  # A full pipe already holds a pending wake-up
+            loop.add_reader(upstream_reader.fileno(), self.receive, index, upstream_reader)
+            self.processes.append(process)
+            self.wakes.append(wake_writer)
+            self.upstreams.append(upstream_reader)
+        print(f"🔁 {self.workers} relay workers serving viewers on port {self.port}")
+
+    def publish(self, kind, host_id, payload, origin=0):
+        if not self.ring.write(kind, host_id, payload, origin):
+            return
+        for wake in self.wakes:
+            try:
+                wake.send_bytes(b"")
+            except BlockingIOError:
+                pass
+            except (BrokenPipeError, OSError):
+                pass  # The worker is gone; receive() has already reported it
+
+    def receive(self, index, upstream):
+        """Applies the control events, acknowledgements and audio a worker's viewers sent."""
+        try:
+            while upstream.poll():
+                kind, host_id, origin, payload = upstream.recv()
+                if kind == "feedback":
+                    feedback = json.loads(payload)
+                    # A worker's viewer may ask for a host before it connects, so its feedback can start
+                    # the session; the host then learns it is watched
+                    if feedback["viewers"]:
+                        session = self.server.session_for(host_id)
+                    else:
+                        session = self.server.sessions.get(host_id)
+                    if session is not None:
+                        session.frames.record_relayed_feedback(index, feedback)
+                    continue
+                session = self.server.sessions.get(host_id)  # Gone if it expired; nothing to deliver to
+                if session is None:
+                    continue
+                if kind == "control":
+                    session.ingest_controls(payload)
+                elif kind == "audio":
+                    session.broadcast_audio(payload, None, origin)
+        except (EOFError, OSError):
+            asyncio.get_running_loop().remove_reader(upstream.fileno())
+            for session in list(self.server.sessions.values()):
+                session.frames.record_relayed_feedback(index, None)
+            print(f"❌ Relay worker {index} exited")
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join(1)
+        self.ring.close()
+
+
+class Uplink:
+    """A link-like channel from a worker's session to the main process, usable wherever the
+    server writes to a link (report_viewer_acks, forward_controls)."""
+
+    def __init__(self, upstream, kind, host_id, index):
+        self.upstream = upstream
+        self.kind = kind
+        self.host_id = host_id
+        self.index = index  # The worker's number
+
+    def origin(self, link):
+        return link_origin(self.index, link)
+
+    def send_nowait(self, message, origin=0):
+        try:
+            self.upstream.send((self.kind, self.host_id, origin, message))
+        except (BrokenPipeError, OSError) as e:
+            raise ConnectionError("Main server process is gone") from e
+
+    async def send(self, message):
+        self.send_nowait(message)
+
+
+def link_origin(index, link):
+    """Identifies a viewer link across processes; the top bits name the worker, so the worker that
+    relayed the audio locally skips it when it comes back through the ring."""
+    return (index + 1) << 48 | id(link) & 0xFFFFFFFFFFFF
+
+
+class RelayWorker:
+    """Serves viewers inside a worker process from the records in the ring."""
+
+    def __init__(self, server, index, reader, wake, upstream, stopped):
+        self.server = server
+        self.index = index
+        self.reader = reader
+        self.wake = wake
+        self.upstream = upstream
+        self.stopped = stopped  # Resolved when the main process goes away
+        self.session_tasks = {}  # Host ID -> (session, tasks that report to the main process)
+
+    def session(self, host_id):
+        """Returns the worker's session for a host, wiring it to the main process the first time."""
+        session = self.server.session_for(host_id)
+        if session is None:
+            return None
+        entry = self.session_tasks.get(host_id)
+        if entry is None or entry[0] is not session:  # New, or recreated after the old one expired
+            if entry is not None:
+                for task in entry[1]:
+                    task.cancel()
+            session.uplink = Uplink(self.upstream, "audio", host_id, self.index)
+            self.session_tasks[host_id] = (session, [
+                asyncio.create_task(self.server.report_viewer_acks(Uplink(self.upstream, "feedback", host_id, self.index), session.frames)),
+                asyncio.create_task(self.server.forward_controls(Uplink(self.upstream, "control", host_id, self.index), session)),
+            ])
+        return session
+
+    def forget(self, host_id, session):
+        """Stops reporting for a session that expired."""
+        entry = self.session_tasks.get(host_id)
+        if entry is not None and entry[0] is session:
+            for task in entry[1]:
+                task.cancel()
+            del self.session_tasks[host_id]
+
+    def on_wake(self):
+        try:
+            while self.wake.poll():
+                self.wake.recv_bytes()
+        except (EOFError, OSError):
+            asyncio.get_running_loop().remove_reader(self.wake.fileno())
+            print(f"❌ Relay worker {self.index} lost the main server process, exiting")
+            self.stopped.set_result(None)
+            return
+        for kind, host_id, origin, payload in self.reader.read():
+            if kind == RECORD_CONFIG:
+                self.apply_config(payload)
+                continue
+            if kind == RECORD_AUDIO:
+                # Only for listeners already here, so audio never starts a session
+                session = self.server.sessions.get(host_id)
+                if session is not None and origin >> 48 != self.index + 1:  # Ours went out when it was sent
+                    session.relay_audio(payload, None)
+                continue
+            session = self.session(host_id)  # Frames and cursor updates are kept for viewers who join later
+            if session is None:
+                continue
+            session.last_active = time.time()  # Keeps the keyframe for late viewers while the host streams
+            if kind == RECORD_FRAME:
+                session.ingest_frame(payload)
+            elif kind == RECORD_CURSOR:
+                session.relay_cursor(payload)
+
+    def apply_config(self, payload):
+        config_channel = self.server.config_channel
+        update = json.loads(payload)
+        with config_channel.lock:
+            config_channel.values.update(update["config"])
+            config_channel.version = update["version"]
+        config_channel.push(payload)
+
+    async def serve_viewer(self, websocket):
+        if self.server.peer_role(websocket) == "host":
+            await websocket.close(1008, "Hosts connect to the main port")
+            return
+        self.session(self.server.session_id(websocket))  # Wired up before the handler attaches to it
+        await self.server.mux_handler(websocket)
+
+
+def worker_main(index, ring_name, start, port, config_snapshot, wake, upstream):
+    """Entry point of a relay worker process."""
+    asyncio.run(run_worker(index, ring_name, start, port, config_snapshot, wake, upstream))
+
+
+async def run_worker(index, ring_name, start, port, config_snapshot, wake, upstream):
+    import websockets
+    import server  # Imported here: the worker reuses the server's sessions and handlers
+
+    loop = asyncio.get_running_loop()
+    server.config_channel.values.update(config_snapshot["config"])
+    server.config_channel.version = config_snapshot["version"]
+    server.config_channel.loop = loop
+    worker = RelayWorker(server, index, RingReader(ring_name, start), wake, upstream, loop.create_future())
+    loop.add_reader(wake.fileno(), worker.on_wake)
+    await websockets.serve(worker.serve_viewer, server.HOST, port, reuse_port=True, max_size=None)
+    asyncio.create_task(server.expire_sessions(worker.forget))
+    await worker.stopped  # Or until the main process terminates it
@@ -1,29 +1,39 @@
 import asyncio
-import random
+import argparse
+import atexit
+import sys
 import websockets
-import io
 import json
+import math
 import threading
+from aiohttp import web
 from flask import Flask, Response, render_template, request
-from flask_socketio import SocketIO
-from PIL import Image
 import requests
-import zlib
 import socket
+import struct
+import time
+import collections
+import itertools
+from urllib.parse import urlsplit, unquote, parse_qs
+import protocol
+import mux
+import metrics
+import relay
+import recorder
 
 # Flask Setup
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*")
 
 # Debug Mode
 DEBUG = False
 
-# Shared Variables (Thread-Safe)
-image_data = None  # Stores received image
-display_lock = asyncio.Lock()  # Prevents race conditions
-mouse_event = None  # Stores mouse event
-image_updated = asyncio.Event()  # Global Event for image update
-mouse_event_updated = asyncio.Event()
+# Frame fan-out
+VIEWER_BUFFER_LIMIT = 1024 * 1024  # Bytes queued on a viewer socket before its frames start coalescing
+DELTA_BACKLOG_LIMIT = 8  # Deltas that cannot be merged (copies) kept for one viewer or for late joiners before waiting for a keyframe
+AUDIO_BUFFER_LIMIT = 64 * 1024  # Bytes queued for a listener before its audio packets are dropped
+RESUME_GRACE = 30  # Seconds a dropped peer can reconnect with its resume token and pick up where it left off
+RESUME_TOKENS_KEPT = 256  # Viewer states remembered for resuming, per session
+CURSOR_BUFFER_LIMIT = 64 * 1024  # Bytes queued for a viewer before cursor updates are dropped; a later one replaces them
 
 # Network Configuration
 HOST = "0.0.0.0"
@@ -33,12 +43,22 @@ IMAGE_SENDER_PORT = 2222
 CONTROL_PORT = 3333
 CONTROL_SENDER_PORT = 4444
 VOICE_SENDER_PORT = 5555
+CONFIG_PORT = 6666
+MUX_PORT = 7777  # One multiplexed connection per peer; the ports above remain for older peers
+WEB_INTERFACE_PORT = 8080
+RELAY_PORT = 8888  # Viewers only, served by relay worker processes when they are enabled
+IP_LOOKUP_TIMEOUT = 5
+IP_LOOKUP_RETRY_MAX = 300  # Longest wait, in seconds, between public IP lookups that keep failing
 
 def get_ip_address():
-    '''Get public IP address'''
+    '''Get public IP address, or None if the lookup fails'''
     if DEBUG:
         return '127.0.0.1'
-    return requests.get('https://api64.ipify.org').text
+    try:
+        return requests.get('https://api64.ipify.org', timeout=IP_LOOKUP_TIMEOUT).text
+    except requests.exceptions.RequestException as e:
+        print(f"⚠️ Public IP lookup failed: {e}")
+        return None
 
 config = {
     "host": HOST,
@@ -48,86 +68,951 @@ config = {
     "control_sender_port": CONTROL_SENDER_PORT,
     "resolution_multiplier": 1,
     "refresh_rate": 10,
-    "server_uri": get_ip_address(),
     "voice_sender_port" : VOICE_SENDER_PORT,
+    "config_port": CONFIG_PORT,
+    "mux_port": MUX_PORT,
+    "web_interface_port": WEB_INTERFACE_PORT,
+    "relay_port": 0,  # Set to RELAY_PORT once relay workers are running; viewers then connect there
+    "adaptive_quality": True,
+    "max_quality": 80,
+    "target_latency": 250,  # Milliseconds from capture to paint
+    "bandwidth_budget": 0,  # Kilobits per second, 0 for unlimited
 }
 
+
+class ConfigChannel:
+    """Versions the config and pushes changed keys to subscribed clients as soon as they change."""
+
+    def __init__(self, values):
+        self.values = values
+        self.version = 1
+        self.lock = threading.Lock()  # Updates arrive on the Flask thread, pushes go out on the asyncio loop
+        self.subscribers = set()  # Links that receive pushed changes
+        self.loop = None
+
+    def snapshot(self):
+        with self.lock:
+            return {"version": self.version, "config": dict(self.values)}
+
+    def update(self, changes, keep_existing=False):
+        """Applies changes from any thread and schedules a push of the keys whose values differ.
+        With keep_existing, keys that already have a value are left alone."""
+        with self.lock:
+            diff = {
+                key: value for key, value in changes.items()
+                if self.values.get(key) != value and not (keep_existing and key in self.values)
+            }
+            if not diff:
+                return
+            self.values.update(diff)
+            self.version += 1
+            message = json.dumps({"version": self.version, "config": diff})
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.push, message)
+
+    def push(self, message):
+        for link in self.subscribers:
+            link.send_nowait(message)
+        if relay_pool is not None:
+            relay_pool.publish(relay.RECORD_CONFIG, "", message.encode() if isinstance(message, str) else message)
+
+
+config_channel = ConfigChannel(config)
+
+
+async def resolve_server_uri():
+    """Looks up the public IP off the event loop and pushes it to clients, unless server_uri is already set.
+
+    Until it is known the config has no server_uri, so clients keep the address they connected to.
+    A failed lookup is retried in the background, waiting longer each time.
+    """
+    delay = IP_LOOKUP_TIMEOUT
+    while "server_uri" not in config_channel.snapshot()["config"]:
+        address = await asyncio.to_thread(get_ip_address)
+        if address:
+            config_channel.update({"server_uri": address}, keep_existing=True)
+            return
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, IP_LOOKUP_RETRY_MAX)
+
+class ViewerSlot:
+    """Holds the frames not yet written to one viewer, coalescing them so only the newest survives."""
+
+    def __init__(self, link, metric_set):
+        self.link = link  # SocketLink or MuxLink the frames are written to
+        self.metrics = metric_set
+        self.pending = []  # (message, arrival time): a keyframe, then deltas, consecutive tiles merged into one
+        self.ready = asyncio.Event()
+        self.sending = False
+        self.sequence = None  # Sequence number of the newest frame handed to the socket
+        self.acked = None  # Sequence number of the newest frame the viewer reported as painted
+        self.visible = True  # False while the viewer's tab is hidden
+        self.awaiting_keyframe = False  # Set after deltas had to be dropped; only a keyframe can follow
+        self.rendition = 0  # Index into protocol.RENDITION_SCALES of the frames this viewer receives
+        self.viewport = None  # (width, height) in device pixels the viewer shows the picture at
+        self.step_down = 0  # Renditions below the one fitting the viewport, while the viewer cannot keep up
+        self.review = (time.time(), 0, 0)  # Time, sent and dropped counts when the rendition was last reviewed
+        self.last_missed = 0  # When the viewer last missed frames
+        self.resume_token = None  # Names the viewer across reconnects
+        self.sent = 0
+        self.dropped = 0  # Frames superseded before they could be sent
+
+    def is_writable(self):
+        """Checks whether a frame can be written straight to the socket without queueing."""
+        if self.pending or self.sending or self.awaiting_keyframe:
+            return False
+        return self.link.buffered() < VIEWER_BUFFER_LIMIT
+
+    def put(self, header, message, received_at=None):
+        """Queues a frame, replacing or merging whatever this viewer has not received yet."""
+        received_at = received_at or time.time()
+        if header.kind == protocol.FRAME_FULL:
+            self.dropped += len(self.pending)
+            self.pending = [(message, received_at)]
+            self.awaiting_keyframe = False
+        elif self.awaiting_keyframe:
+            self.dropped += 1
+            return
+        elif header.kind == protocol.FRAME_TILES and self.pending and protocol.unpack_header(self.pending[-1][0]).kind != protocol.FRAME_FULL:
+            # Collapse consecutive deltas into one, keeping the newest version of every tile
+            self.pending[-1] = (merge_tiles(self.pending[-1][0], header, message), received_at)
+            self.dropped += 1
+        elif len(self.pending) > DELTA_BACKLOG_LIMIT:
+            # Copies cannot be merged; rather than queue them without end, skip ahead to the next keyframe
+            self.dropped += len(self.pending) + 1
+            self.pending = []
+            self.awaiting_keyframe = True
+            return
+        else:
+            self.pending.append((message, received_at))
+        self.ready.set()
+
+    async def drain(self):
+        """Writes queued frames to the viewer, waiting for the socket whenever it is backed up."""
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            messages, self.pending = self.pending, []
+            self.sending = True
+            try:
+                for message, received_at in messages:
+                    await self.link.send(message)
+                    self.sequence = protocol.unpack_header(message).sequence
+                    self.sent += 1
+                    self.metrics.observe("trisma_relay_seconds", time.time() - received_at)
+            except (websockets.exceptions.ConnectionClosed, ConnectionError):
+                return
+            finally:
+                self.sending = False
+
+
+def merge_tiles(message, header, newer):
+    """Returns a delta with the tiles of a newer FRAME_TILES message patched in, under the newer header.
+    A frame's tiles are drawn after its copies, so the newer tiles can join a FRAME_COPY as well."""
+    tiles = {(x, y): (x, y, w, h, image) for x, y, w, h, image in protocol.iter_tiles(message)}
+    tiles.update(((x, y), (x, y, w, h, image)) for x, y, w, h, image in protocol.iter_tiles(newer))
+    copies = list(protocol.iter_copies(message))
+    if copies:
+        return protocol.pack_copy_frame(header, copies, tiles.values())
+    return protocol.pack_tile_frame(header, tiles.values())
+
+
+FRAME_ARRIVALS_KEPT = 256  # Arrival times remembered for matching viewer acknowledgements
+VIEWPORT_TOLERANCE = 0.8  # A rendition counts as filling a viewport down to this share of its size
+RENDITION_REVIEW_INTERVAL = 2  # Seconds between checks that a viewer keeps up with its rendition
+RENDITION_DROP_RATIO = 0.5  # A viewer missing more than this share of its frames moves to a smaller rendition
+RENDITION_RECOVER_AFTER = 10  # Seconds without missed frames before it moves back up one
+
+
+class RenditionCache:
+    """The frames that rebuild one rendition's current picture for viewers that join or switch to it."""
+
+    def __init__(self):
+        self.keyframe = None  # Last full frame of this rendition
+        self.deltas = []  # Since the keyframe: [header, copies, tiles keyed by (x, y)], tiles merged into the newest entry
+        self.history_complete = True  # False once too many copies piled up; late viewers then wait for a keyframe
+
+    def store(self, header, message):
+        """Records a frame. Returns False for a delta that does not apply to the keyframe."""
+        if header.kind == protocol.FRAME_FULL:
+            self.keyframe = message
+            self.deltas = []
+            self.history_complete = True
+        elif self.keyframe is not None and self.matches_keyframe(header):
+            self.record_delta(header, message)
+        else:
+            return False
+        return True
+
+    def clear(self):
+        self.keyframe = None
+        self.deltas = []
+        self.history_complete = True
+
+    def current_frame_messages(self):
+        """Returns the messages that rebuild the current picture: the keyframe plus the deltas since, merged
+        where possible. Empty if there is no keyframe or the deltas were not all kept."""
+        if self.keyframe is None or not self.history_complete:
+            return []
+        messages = [self.keyframe]
+        for header, copies, tiles in self.deltas:
+            if copies:
+                messages.append(protocol.pack_copy_frame(header, copies, tiles.values()))
+            else:
+                messages.append(protocol.pack_tile_frame(header, tiles.values()))
+        return messages
+
+    def record_delta(self, header, message):
+        """Adds a delta to the history late viewers rebuild the picture from."""
+        if not self.history_complete:
+            return
+        copies = list(protocol.iter_copies(message))
+        if copies or not self.deltas:
+            if len(self.deltas) >= DELTA_BACKLOG_LIMIT:
+                self.deltas = []
+                self.history_complete = False
+                return
+            self.deltas.append([header, copies, {}])
+        entry = self.deltas[-1]
+        entry[0] = header
+        for x, y, w, h, image in protocol.iter_tiles(message):
+            entry[2][(x, y)] = (x, y, w, h, bytes(image))
+
+    def matches_keyframe(self, header):
+        """Checks that a delta frame uses the keyframe's size, codec and flags."""
+        base = protocol.unpack_header(self.keyframe)
+        return (header.width, header.height, header.codec, header.flags) == (base.width, base.height, base.codec, base.flags)
+
+
+class FrameHub:
+    """Fans frames from the streaming client out to every connected viewer, each watching one rendition."""
+
+    def __init__(self, metric_set):
+        self.metrics = metric_set
+        self.arrivals = collections.OrderedDict()  # Sequence number -> arrival time
+        self.viewers = set()
+        self.renditions = {}  # Rendition -> RenditionCache
+        self.keyframe_requested = False  # Reported to the client, which then sends keyframes right away
+        self.latest = None  # Header of the newest frame of any rendition
+        self.feedback_updated = asyncio.Event()  # Set on acks and whenever viewers join, leave, hide or switch renditions
+        self.relayed = {}  # Relay worker number -> its viewers' feedback ({"acked", "viewers", "watching", "renditions"})
+        self.departed = collections.OrderedDict()  # Resume token -> (left at, rendition, viewport, step_down) of dropped viewers
+        self.recording = False  # The recorder counts as a watcher of the full size, so the host keeps capturing for it
+        self.replaying = False  # Fed from a recording: only the full size, with the original capture timestamps
+
+    def cache(self, rendition):
+        cache = self.renditions.get(rendition)
+        if cache is None:
+            cache = self.renditions[rendition] = RenditionCache()
+        return cache
+
+    def request_keyframe(self):
+        self.keyframe_requested = True
+        self.feedback_updated.set()
+
+    def restart(self):
+        """Forgets the stored frames when a new host connection starts over: its deltas cannot apply to
+        them, so late viewers wait for its first keyframe. Viewers keep what they show until then."""
+        for cache in self.renditions.values():
+            cache.clear()
+        self.request_keyframe()
+
+    def publish(self, header, message):
+        """Stores a frame and hands it to every viewer of its rendition. Returns False if the frame cannot be shown."""
+        rendition = protocol.frame_rendition(header)
+        if not self.cache(rendition).store(header, message):
+            return False  # Tiles without a matching keyframe cannot be displayed
+        self.latest = header
+        received_at = time.time()
+        if header.sequence not in self.arrivals:  # Every rendition of a capture shares its sequence number
+            self.arrivals[header.sequence] = received_at
+            if len(self.arrivals) > FRAME_ARRIVALS_KEPT:
+                self.arrivals.popitem(last=False)
+            # Compares clocks of two machines, so only meaningful when they are synchronized; a replayed
+            # frame was captured when it was recorded
+            if not self.replaying:
+                self.metrics.observe("trisma_capture_to_relay_seconds", max(0, received_at - header.timestamp))
+
+        # Idle viewers get the frame written straight to their socket; busy ones coalesce it in their slot
+        for slot in self.viewers:
+            if slot.rendition != rendition:
+                continue
+            self.metrics.observe("trisma_viewer_buffered_bytes", slot.link.buffered(), metrics.BYTE_BUCKETS)
+            if slot.is_writable():
+                slot.link.send_nowait(message)
+                slot.sequence = header.sequence
+                slot.sent += 1
+                self.metrics.observe("trisma_relay_seconds", time.time() - received_at)
+            else:
+                waiting = slot.awaiting_keyframe
+                slot.put(header, message, received_at)
+                if slot.awaiting_keyframe and not waiting:
+                    self.request_keyframe()  # The slot dropped its backlog
+        self.review_renditions(received_at)
+        return True
+
+    def renditions_in_use(self):
+        """Returns the renditions watched by this process's viewers and by those of relay workers."""
+        in_use = {slot.rendition for slot in self.viewers}
+        if self.recording:
+            in_use.add(0)
+        for feedback in self.relayed.values():
+            in_use.update(feedback.get("renditions", ()))
+        return in_use
+
+    def fitting_rendition(self, viewport):
+        """Returns the smallest rendition that still fills a viewport; the full size if either is unknown."""
+        if viewport is None or self.latest is None:
+            return 0
+        scale = protocol.RENDITION_SCALES[protocol.frame_rendition(self.latest)]
+        width, height = self.latest.width * scale, self.latest.height * scale
+        fitting = 0
+        for rendition, scale in enumerate(protocol.RENDITION_SCALES):
+            if width / scale >= viewport[0] * VIEWPORT_TOLERANCE and height / scale >= viewport[1] * VIEWPORT_TOLERANCE:
+                fitting = rendition
+        return fitting
+
+    def select_rendition(self, slot):
+        """Moves a viewer to the rendition that fits its viewport, less the steps its link needs.
+        The switch starts from the rendition's current picture, or waits for its next keyframe."""
+        rendition = min(len(protocol.RENDITION_SCALES) - 1, self.fitting_rendition(slot.viewport) + slot.step_down)
+        if self.replaying:
+            rendition = 0  # The only size that was recorded
+        if rendition == slot.rendition:
+            return
+        produced = rendition in self.renditions_in_use()
+        slot.rendition = rendition
+        slot.pending = []
+        slot.awaiting_keyframe = False
+        if not produced:
+            self.cache(rendition).clear()  # Left over from when someone last watched it
+        messages = self.cache(rendition).current_frame_messages()
+        for message in messages:
+            slot.put(protocol.unpack_header(message), message)
+        if not messages:
+            slot.awaiting_keyframe = True
+            self.request_keyframe()
+        self.feedback_updated.set()  # The client may have to start or stop a rendition
+
+    def review_renditions(self, now):
+        """Steps viewers that miss too many frames down a rendition, and back up once they stop missing any."""
+        for slot in list(self.viewers):
+            reviewed_at, sent, dropped = slot.review
+            if now - reviewed_at < RENDITION_REVIEW_INTERVAL:
+                continue
+            slot.review = (now, slot.sent, slot.dropped)
+            missed = slot.dropped - dropped
+            if missed > RENDITION_DROP_RATIO * (missed + slot.sent - sent):
+                slot.step_down = min(slot.step_down + 1, len(protocol.RENDITION_SCALES) - 1)
+                slot.last_missed = now
+            elif missed:
+                slot.last_missed = now
+            elif slot.step_down and now - slot.last_missed > RENDITION_RECOVER_AFTER:
+                slot.step_down -= 1
+                slot.last_missed = now  # Proves itself again before the next step up
+            self.select_rendition(slot)
+
+    def resume_state(self, token):
+        """Returns (rendition, viewport, step_down) of the viewer that last held a resume token, or None.
+        The viewer may still be subscribed if its dropped connection has not timed out yet."""
+        for slot in self.viewers:
+            if slot.resume_token == token:
+                return slot.rendition, slot.viewport, slot.step_down
+        state = self.departed.pop(token, None)
+        if state is not None and time.time() - state[0] <= RESUME_GRACE:
+            return state[1:]
+        return None
+
+    def subscribe(self, link, resume_token=None):
+        """Registers a viewer and queues the current screen for it."""
+        slot = ViewerSlot(link, self.metrics)
+        slot.resume_token = resume_token
+        state = self.resume_state(resume_token) if resume_token else None
+        if state is not None:
+            slot.rendition, slot.viewport, slot.step_down = state  # Straight back to what it watched
+        else:
+            # Until the viewer reports its viewport it joins the sharpest rendition already streaming
+            slot.rendition = min(self.renditions_in_use(), default=0)
+        cache = self.cache(slot.rendition)
+        messages = cache.current_frame_messages()
+        for message in messages:
+            slot.put(protocol.unpack_header(message), message)
+        if cache.keyframe is not None and not messages:
+            slot.awaiting_keyframe = True  # Deltas alone cannot rebuild the screen
+            self.request_keyframe()
+        self.viewers.add(slot)
+        self.feedback_updated.set()
+        return slot
+
+    def unsubscribe(self, slot):
+        self.viewers.discard(slot)
+        token = slot.resume_token
+        if token and not any(other.resume_token == token for other in self.viewers):
+            self.departed.pop(token, None)
+            self.departed[token] = (time.time(), slot.rendition, slot.viewport, slot.step_down)
+            if len(self.departed) > RESUME_TOKENS_KEPT:
+                self.departed.popitem(last=False)
+        self.feedback_updated.set()  # The slowest viewer may have left
+
+    def set_visible(self, slot, visible):
+        slot.visible = visible
+        self.feedback_updated.set()
+
+    def set_viewport(self, slot, viewport):
+        width, height = viewport
+        slot.viewport = (int(width), int(height))
+        self.select_rendition(slot)
+
+    def record_relayed_feedback(self, worker, feedback):
+        """Stores the feedback a relay worker reported for its viewers (None once the worker is gone)."""
+        if feedback is None:
+            self.relayed.pop(worker, None)
+        else:
+            if feedback.pop("keyframe", False):
+                self.request_keyframe()  # One of the worker's viewers needs it
+            self.relayed[worker] = feedback
+        self.feedback_updated.set()
+
+    def viewer_count(self):
+        return len(self.viewers) + sum(feedback["viewers"] for feedback in self.relayed.values())
+
+    def watching(self):
+        """Returns the number of viewers whose tab is visible, including those of relay workers and the recorder."""
+        watching = sum(1 for slot in self.viewers if slot.visible) + sum(feedback["watching"] for feedback in self.relayed.values())
+        return watching + self.recording
+
+    def record_ack(self, slot, sequence, decode=None, paint=None):
+        """Stores a viewer's acknowledgement along with the decode and paint times it reported."""
+        slot.acked = sequence
+        self.feedback_updated.set()
+        received_at = self.arrivals.get(sequence)
+        if received_at is not None:
+            self.metrics.observe("trisma_viewer_ack_seconds", time.time() - received_at)
+        if decode is not None:
+            self.metrics.observe("trisma_browser_decode_seconds", float(decode))
+        if paint is not None:
+            self.metrics.observe("trisma_browser_paint_seconds", float(paint))
+
+    def slowest_ack(self):
+        """Returns the oldest sequence number painted by the viewers of the sharpest rendition in use, or None.
+        The client tunes that rendition; viewers moved to a smaller one no longer hold back the rest."""
+        if self.latest is None:
+            return None
+        sharpest = min(self.renditions_in_use(), default=0)
+        acked = [slot.acked for slot in self.viewers if slot.rendition == sharpest]
+        acked += [feedback["acked"] for feedback in self.relayed.values() if min(feedback.get("renditions") or [0]) == sharpest]
+        lags = [(self.latest.sequence - sequence) & 0xFFFFFFFF for sequence in acked if sequence is not None]
+        return (self.latest.sequence - max(lags)) & 0xFFFFFFFF if lags else None
+
+    def stats(self):
+        """Returns per-viewer delivery and lag counters."""
+        latest = self.latest.sequence if self.latest else None
+        viewers = []
+        for slot in list(self.viewers):
+            lag = (latest - slot.sequence) & 0xFFFFFFFF if latest is not None and slot.sequence is not None else None
+            viewers.append({
+                "address": str(slot.link.remote_address),
+                "sent": slot.sent,
+                "dropped": slot.dropped,
+                "lag": lag,
+                "acked": slot.acked,
+                "visible": slot.visible,
+                "rendition": slot.rendition,
+                "viewport": slot.viewport,
+                "pending": len(slot.pending),
+                "buffered_bytes": slot.link.buffered(),
+            })
+        return {"latest_sequence": latest, "viewers": viewers}
+
+
+# Remote control
+CONTROL_QUEUE_LIMIT = 1024  # Events kept for a host that is not draining its queue
+
+
+class ControlQueue:
+    """Ordered control events for one host. Consecutive moves collapse into the newest position."""
+
+    def __init__(self, limit=CONTROL_QUEUE_LIMIT):
+        self.events = collections.deque()
+        self.limit = limit
+        self.updated = asyncio.Event()
+        self.dropped = 0
+
+    def put(self, event):
+        if event.get("action") == "move" and self.events and self.events[-1].get("action") == "move":
+            self.events[-1] = event
+        else:
+            if len(self.events) >= self.limit:
+                # Only reachable while no host is draining; the oldest input is the least useful
+                self.events.popleft()
+                self.dropped += 1
+            self.events.append(event)
+        self.updated.set()
+
+    async def get_batch(self):
+        """Waits for events and takes every queued one, oldest first."""
+        while not self.events:
+            self.updated.clear()
+            await self.updated.wait()
+        batch = list(self.events)
+        self.events.clear()
+        return batch
+
+    def requeue(self, batch):
+        """Puts back a batch that could not be delivered, ahead of anything newer."""
+        self.events.extendleft(reversed(batch))
+        self.updated.set()
+
+
+# Sessions
+DEFAULT_SESSION = "default"  # Used by peers that connect without a host ID in the URL path
+MAX_SESSIONS = 64
+SESSION_IDLE_TIMEOUT = 300  # Seconds a session without host or viewers is kept around
+
+
+class Session:
+    """State for one streaming host: its frames, control queue and audio listeners."""
+
+    def __init__(self, host_id):
+        self.host_id = host_id
+        self.metrics = metrics.MetricSet()
+        self.frames = FrameHub(self.metrics)
+        self.controls = ControlQueue()
+        self.voice_clients = set()  # Links that receive audio
+        self.cursor_links = set()  # Viewer links that receive cursor updates
+        self.cursor = None  # Newest cursor update, sent to viewers as they join
+        self.connections = 0  # Open WebSockets of any kind attached to this session
+        self.host_connected = False
+        self.host_connection = None  # MuxConnection of the current host
+        self.host_token = None  # Resume token of the host the stored frames came from
+        self.host_left_at = 0
+        self.peers = {}  # Resume token -> MuxConnection currently holding it
+        self.last_active = time.time()
+        self.uplink = None  # In a relay worker: forwards this session's viewer audio to the main process
+        self.replaying = host_id.startswith(recorder.REPLAY_PREFIX)  # Fed from a recording instead of a host
+        self.frames.replaying = self.replaying
+        self.frames.recording = session_recorder is not None and not self.replaying
+
+    def stats(self):
+        return {
+            "host_id": self.host_id,
+            "host_connected": self.host_connected,
+            "replaying": self.replaying,
+            "recording": self.frames.recording,
+            "viewers": self.frames.viewer_count(),
+            "watching": self.frames.watching(),
+            "listeners": len(self.voice_clients),
+            "queued_controls": len(self.controls.events),
+        }
+
+    def attach_host(self, connection, token):
+        """Makes a connection the session's host. Returns True if it resumes the previous host connection:
+        same resume token, and that connection dropped less than RESUME_GRACE seconds ago or is only now
+        being replaced. A resumed host carries on from the frames it already sent."""
+        resumed = bool(token) and token == self.host_token and (
+            self.host_connected or time.time() - self.host_left_at <= RESUME_GRACE)
+        self.host_token = token
+        self.host_connection = connection
+        self.host_connected = True
+        if not resumed:
+            self.frames.restart()
+        return resumed
+
+    def detach_host(self, connection):
+        if self.host_connection is connection:  # Not if a reconnect has already replaced it
+            self.host_connection = None
+            self.host_connected = False
+            self.host_left_at = time.time()
+
+    def claim_resume_token(self, token, connection):
+        """Hands a resume token to a new connection, dropping the one that held it: that is what a reconnecting
+        peer left behind, and its TCP connection may take a long time to time out on its own."""
+        if not token:
+            return
+        previous = self.peers.get(token)
+        if previous is not None and previous is not connection:
+            previous.abort()
+        self.peers[token] = connection
+
+    def release_resume_token(self, token, connection):
+        if token and self.peers.get(token) is connection:
+            del self.peers[token]
+
+    def ingest_frame(self, message):
+        """Publishes a frame from the host. Only the header is parsed; images are relayed untouched."""
+        try:
+            header = protocol.unpack_header(message)
+        except (ValueError, struct.error) as e:
+            print(f"⚠️ Dropping malformed frame: {e}")
+            return False
+        if not self.frames.publish(header, message):
+            return False
+        if relay_pool is not None:
+            relay_pool.publish(relay.RECORD_FRAME, self.host_id, message)
+        if self.frames.recording and session_recorder.record(self.host_id, header, message):
+            self.frames.request_keyframe()  # Starts the next segment, or recovers from frames the disk could not take
+        return True
+
+    def ingest_cursor(self, message):
+        """Relays a cursor update from the host to every viewer."""
+        try:
+            protocol.unpack_cursor(message)
+        except (ValueError, struct.error) as e:
+            print(f"⚠️ Dropping malformed cursor update: {e}")
+            return
+        self.relay_cursor(message)
+        if relay_pool is not None:
+            relay_pool.publish(relay.RECORD_CURSOR, self.host_id, message)
+
+    def relay_cursor(self, message):
+        """Sends a cursor update to the viewers in this process, skipping those that are backed up."""
+        self.cursor = message
+        for link in self.cursor_links:
+            if link.buffered() < CURSOR_BUFFER_LIMIT:
+                link.send_nowait(message)
+
+    def ingest_controls(self, message):
+        """Queues the events of a viewer's control message for the host."""
+        try:
+            events = protocol.parse_control_message(message)
+        except (ValueError, struct.error) as e:  # JSONDecodeError is a ValueError
+            print(f"⚠️ Invalid control message: {message!r} - Error: {e}")
+            return
+        for event in events:
+            if isinstance(event, dict):
+                self.controls.put(event)
+
+    def record_client_metrics(self, message):
+        """Adds the stage timings reported by the host to the session's histograms."""
+        try:
+            for frame in json.loads(message)["frames"]:
+                for stage, seconds in frame.items():
+                    if stage not in ("sequence", "bytes"):
+                        self.metrics.observe("trisma_client_stage_seconds", float(seconds), stage=stage)
+                self.metrics.observe("trisma_frame_bytes", int(frame["bytes"]), metrics.BYTE_BUCKETS)
+        except (json.JSONDecodeError, AttributeError, KeyError, TypeError, ValueError) as e:
+            print(f"⚠️ Invalid metrics report: {e}")
+
+    def broadcast_audio(self, message, sender, origin=0):
+        """Forwards audio to every other link in the session, including those served by relay workers."""
+        self.relay_audio(message, sender)
+        if relay_pool is not None:
+            relay_pool.publish(relay.RECORD_AUDIO, self.host_id, message, origin)
+        elif self.uplink is not None and sender is not None:
+            self.uplink.send_nowait(message, self.uplink.origin(sender))
+
+    def relay_audio(self, message, sender):
+        """Forwards audio to the other links in this process, never back to its sender."""
+        for link in self.voice_clients:
+            if link is not sender and link.buffered() < AUDIO_BUFFER_LIMIT:
+                link.send_nowait(message)
+
+
+sessions = {}  # Host ID -> Session
+relay_pool = None  # relay.RelayPool when viewers are served by relay worker processes
+session_recorder = None  # recorder.Recorder when sessions are recorded to disk; never set in relay workers
+replay_numbers = itertools.count(1)
+
+
+def session_id(websocket):
+    """Reads the host ID from the request path, e.g. ws://server:1111/<host_id>."""
+    host_id = unquote(urlsplit(websocket.request.path).path).strip("/")
+    return host_id[:64] or DEFAULT_SESSION
+
+
+def peer_role(websocket):
+    """Reads ?role=host or ?role=viewer from the request path; viewer if absent."""
+    return parse_qs(urlsplit(websocket.request.path).query).get("role", ["viewer"])[0]
+
+
+def resume_token(websocket):
+    """Reads the ?resume= token a peer sends on every connection, so a reconnect can be matched to the
+    connection it replaces. None if absent."""
+    return parse_qs(urlsplit(websocket.request.path).query).get("resume", [""])[0][:64] or None
+
+
+def session_for(host_id):
+    """Returns the session for a host ID, creating it if needed. Returns None when full."""
+    session = sessions.get(host_id)
+    if session is None:
+        if len(sessions) >= MAX_SESSIONS:
+            return None
+        session = sessions[host_id] = Session(host_id)
+        print(f"🆕 Session {host_id} created")
+    return session
+
+
+def open_session(websocket):
+    """Attaches a connection to its session, creating the session if needed. Returns None when full."""
+    session = session_for(session_id(websocket))
+    if session is None:
+        return None
+    session.connections += 1
+    session.last_active = time.time()
+    return session
+
+
+def close_session(session):
+    """Detaches a connection from its session."""
+    session.connections -= 1
+    session.last_active = time.time()
+
+
+async def expire_sessions(on_expire=None):
+    """Drops sessions that have had no connections, here or at relay workers, for SESSION_IDLE_TIMEOUT
+    seconds, and calls on_expire(host_id, session) for each."""
+    while True:
+        await asyncio.sleep(SESSION_IDLE_TIMEOUT / 10)
+        now = time.time()
+        for host_id, session in list(sessions.items()):
+            if session.frames.relayed and session.frames.viewer_count():
+                session.last_active = now  # Its viewers are served by relay workers
+            elif session.connections == 0 and now - session.last_active > SESSION_IDLE_TIMEOUT:
+                del sessions[host_id]
+                print(f"🗑️ Session {host_id} expired")
+                if on_expire is not None:
+                    on_expire(host_id, session)
+
+
+def with_session(handler):
+    """Wraps a WebSocket handler so it receives the session named in the request path."""
+    async def wrapper(websocket):
+        session = open_session(websocket)
+        if session is None:
+            print(f"❌ Session limit reached, refusing {session_id(websocket)}")
+            await websocket.close(1013, "Too many sessions")
+            return
+        try:
+            await handler(websocket, session)
+        finally:
+            close_session(session)
+    return wrapper
+
 # WebSocket Handlers
-async def receive_and_store_image(websocket):
-    global image_data
-    print("📡 Connected for screen streaming")
-    last_image_data = None
+@with_session
+async def receive_and_store_image(websocket, session):
+    if session.replaying:
+        await websocket.close(1008, "Replay sessions take no host")
+        return
+    print(f"📡 Connected for screen streaming ({session.host_id})")
+    frame_hub = session.frames
+    session.attach_host(websocket, None)  # Older clients cannot resume, so their frames start over
+    reporter = asyncio.create_task(report_viewer_acks(mux.SocketLink(websocket), frame_hub))
     try:
         async for message in websocket:
             # if len(message) > 5 * 1024 * 1024:
             #     print("⚠ Warning: Large image, dropping frame.")
             #     continue
-            if message != last_image_data:
-                async with display_lock:
-                    image_data = message
-                last_image_data = message
-                image_updated.set()  # Notify image sender
+            if session.ingest_frame(message):
                 await websocket.pong()
     except websockets.exceptions.ConnectionClosedError:
         print("❌ Client disconnected unexpectedly!")
     except Exception as e:
         print(f"❌ WebSocket error: {e}")
     finally:
+        session.detach_host(websocket)
+        reporter.cancel()
         print("🔌 Connection closed.")
 
-async def send_mouse_control(websocket):
-    global mouse_event
-    print("🖱️ Connected for mouse control sending")
+async def report_viewer_acks(link, frame_hub, resumed=False):
+    """Tells the streaming client how far the slowest viewer has painted, so it can adapt quality and frame rate,
+    how many viewers are watching, so it can stop capturing while nobody is, and which renditions to produce.
+    The first report to a resumed host also names the newest frame that arrived before it reconnected."""
+    reported = None
     try:
         while True:
-            await mouse_event_updated.wait()
-            await websocket.send(json.dumps(mouse_event))
-            mouse_event_updated.clear()
-    except websockets.exceptions.ConnectionClosed:
-        print("❌ Mouse control sender disconnected.")
+            # Reports right away on connect, so an unwatched client pauses without waiting for a viewer event
+            frame_hub.feedback_updated.clear()
+            feedback = {
+                "acked": frame_hub.slowest_ack(),
+                "viewers": frame_hub.viewer_count(),
+                "watching": frame_hub.watching(),
+                "renditions": sorted(frame_hub.renditions_in_use()),
+            }
+            if frame_hub.keyframe_requested:
+                feedback["keyframe"] = True
+                frame_hub.keyframe_requested = False
+            if resumed:
+                # Unless this is the last frame the host sent, some were lost and it sends a keyframe
+                feedback["resumed"] = frame_hub.latest.sequence if frame_hub.latest else None
+                resumed = False
+            if feedback != reported or "keyframe" in feedback:  # Each request needs its own keyframe
+                await link.send(json.dumps(feedback))
+                reported = feedback
+            await frame_hub.feedback_updated.wait()
+    except (websockets.exceptions.ConnectionClosed, ConnectionError):
+        pass
+
+@with_session
+async def send_mouse_control(websocket, session):
+    print(f"🖱️ Connected for mouse control sending ({session.host_id})")
+    closed = asyncio.ensure_future(websocket.wait_closed())
+    while True:
+        getter = asyncio.ensure_future(session.controls.get_batch())
+        await asyncio.wait([getter, closed], return_when=asyncio.FIRST_COMPLETED)
+        if not getter.done():
+            getter.cancel()  # Leaves the queue untouched for the next host connection
+            print("❌ Mouse control sender disconnected.")
+            return
+        batch = getter.result()
+        try:
+            # Everything queued goes out in one message, binary unless an event only fits in JSON
+            await websocket.send(protocol.encode_control_events(batch) or json.dumps(batch))
+        except websockets.exceptions.ConnectionClosed:
+            session.controls.requeue(batch)
+            print("❌ Mouse control sender disconnected.")
+            return
 
-async def handle_mouse_control(websocket):
-    global mouse_event
-    print("🖱️ Connected for receiving mouse control")
+@with_session
+async def handle_mouse_control(websocket, session):
+    print(f"🖱️ Connected for receiving mouse control ({session.host_id})")
     try:
         async for message in websocket:
-            messageNow = json.loads(message)
-            mouse_event = messageNow
-            mouse_event_updated.set()  # Notify sender
+            session.ingest_controls(message)
     except websockets.exceptions.ConnectionClosed:
         print("❌ Mouse control receiver disconnected.")
 
 
-async def send_image(websocket):
-    print("🌆 Image WebSocket connected for Browser")
+@with_session
+async def send_image(websocket, session):
+    print(f"🌆 Image WebSocket connected for Browser ({session.host_id})")
+    frame_hub = session.frames
+    slot = frame_hub.subscribe(mux.SocketLink(websocket))
+    sender = asyncio.create_task(slot.drain())
     try:
-        while True:
-            await image_updated.wait()  # Wait for an image update
-            async with display_lock:
-                if image_data:
-                    await websocket.send(zlib.decompress(image_data))
-            image_updated.clear()  # Reset the event after sending
+        # Viewers acknowledge every frame they paint
+        async for message in websocket:
+            record_viewer_report(frame_hub, slot, message)
+        print("❌ Image WebSocket disconnected.")
     except websockets.exceptions.ConnectionClosed:
         print("❌ Image WebSocket disconnected.")
+    finally:
+        sender.cancel()
+        frame_hub.unsubscribe(slot)
 
-# Store connected clients
-voice_clients = set()
+def record_viewer_report(frame_hub, slot, message):
+    """Handles a viewer's frame acknowledgement, tab visibility change, viewport size or keyframe request."""
+    try:
+        data = json.loads(message)
+        if "visible" in data:
+            frame_hub.set_visible(slot, bool(data["visible"]))
+        elif "viewport" in data:
+            frame_hub.set_viewport(slot, data["viewport"])
+        elif data.get("keyframe"):
+            frame_hub.request_keyframe()  # The page dropped deltas it could not keep up with
+        else:
+            frame_hub.record_ack(slot, int(data["ack"]), data.get("decode"), data.get("paint"))
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        print(f"⚠️ Invalid viewer message: {message} - Error: {e}")
 
-async def audio_handler(websocket):
-    global voice_clients
-    print(f"🎤 Connected {len(voice_clients)} clients for voice chat")
-    voice_clients.add(websocket)
+@with_session
+async def audio_handler(websocket, session):
+    voice_clients = session.voice_clients
+    print(f"🎤 Connected {len(voice_clients)} clients for voice chat ({session.host_id})")
+    link = mux.SocketLink(websocket)
+    voice_clients.add(link)
     try:
         async for message in websocket:
-            # Forward audio to all connected browser clients
-            websockets.broadcast(voice_clients, message)
+            session.broadcast_audio(message, link)
     except websockets.exceptions.ConnectionClosed:
         print("❌ Audio client disconnected.")
     finally:
-        voice_clients.remove(websocket)
+        voice_clients.remove(link)
         print("🔌 Audio connection closed.")
 
 
+async def subscribe_config(link):
+    """Sends a full config snapshot and registers the link for pushed changes."""
+    config_channel.subscribers.add(link)
+    # Afterwards only changed keys arrive, each with a higher version
+    await link.send(json.dumps(dict(config_channel.snapshot(), snapshot=True)))
+
+
+async def config_handler(websocket):
+    print("⚙️ Config subscriber connected")
+    link = mux.SocketLink(websocket)
+    try:
+        await subscribe_config(link)
+        await websocket.wait_closed()
+    finally:
+        config_channel.subscribers.discard(link)
+        print("🔌 Config subscriber disconnected.")
+
+
+@with_session
+async def mux_handler(websocket, session):
+    """Serves every channel of one peer over a single connection; ?role=host or ?role=viewer picks the side."""
+    role = peer_role(websocket)
+    if role == "host" and session.replaying:
+        await websocket.close(1008, "Replay sessions take no host")
+        return
+    token = resume_token(websocket)
+    connection = mux.MuxConnection(websocket)
+    session.claim_resume_token(token, connection)
+    print(f"🔀 Multiplexed {role} connected ({session.host_id})")
+    tasks = [asyncio.create_task(connection.run_writer())]
+    config_link = connection.channel(protocol.CHANNEL_CONFIG)
+    audio_link = connection.channel(protocol.CHANNEL_AUDIO)
+    session.voice_clients.add(audio_link)
+    slot = None
+    cursor_link = None
+    try:
+        await subscribe_config(config_link)
+        if role == "host":
+            resumed = session.attach_host(connection, token)
+            if resumed:
+                print(f"⏯️ Host resumed its session ({session.host_id})")
+            tasks.append(asyncio.create_task(report_viewer_acks(connection.channel(protocol.CHANNEL_VIDEO), session.frames, resumed)))
+            tasks.append(asyncio.create_task(forward_controls(connection.channel(protocol.CHANNEL_CONTROL), session)))
+        else:
+            slot = session.frames.subscribe(connection.channel(protocol.CHANNEL_VIDEO), token)
+            tasks.append(asyncio.create_task(slot.drain()))
+            cursor_link = connection.channel(protocol.CHANNEL_CURSOR)
+            session.cursor_links.add(cursor_link)
+            if session.cursor is not None:
+                cursor_link.send_nowait(session.cursor)
+
+        async for channel, payload in connection.messages():
+            if channel == protocol.CHANNEL_AUDIO:
+                session.broadcast_audio(payload, audio_link)
+            elif role == "host" and channel == protocol.CHANNEL_VIDEO:
+                session.ingest_frame(payload)
+            elif role == "host" and channel == protocol.CHANNEL_METRICS:
+                session.record_client_metrics(payload)
+            elif role == "host" and channel == protocol.CHANNEL_CURSOR:
+                session.ingest_cursor(payload)
+            elif role != "host" and channel == protocol.CHANNEL_VIDEO:
+                record_viewer_report(session.frames, slot, payload)
+            elif role != "host" and channel == protocol.CHANNEL_CONTROL:
+                session.ingest_controls(payload)
+    except (websockets.exceptions.ConnectionClosed, ConnectionError):
+        pass
+    except ValueError as e:
+        print(f"⚠️ Closing multiplexed connection after invalid fragment: {e}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        if role == "host":
+            session.detach_host(connection)
+        session.release_resume_token(token, connection)
+        if slot is not None:
+            session.frames.unsubscribe(slot)
+        session.cursor_links.discard(cursor_link)
+        session.voice_clients.discard(audio_link)
+        config_channel.subscribers.discard(config_link)
+        print(f"🔌 Multiplexed {role} disconnected ({session.host_id})")
+
+
+async def forward_controls(link, session):
+    """Sends queued control events to the host, putting back any batch that was not written."""
+    while True:
+        batch = await session.controls.get_batch()
+        try:
+            await link.send(protocol.encode_control_events(batch) or json.dumps(batch))
+        except (websockets.exceptions.ConnectionClosed, ConnectionError, asyncio.CancelledError):
+            session.controls.requeue(batch)
+            raise
+
 
 async def start_websockets():
     print("🚀 Starting WebSocket servers...")
@@ -137,13 +1022,144 @@ async def start_websockets():
             websockets.serve(handle_mouse_control, HOST, CONTROL_PORT),
             websockets.serve(send_mouse_control, HOST, CONTROL_SENDER_PORT),
             websockets.serve(send_image, HOST, IMAGE_SENDER_PORT),
-            websockets.serve(audio_handler, HOST, VOICE_SENDER_PORT)
+            websockets.serve(audio_handler, HOST, VOICE_SENDER_PORT),
+            websockets.serve(config_handler, HOST, CONFIG_PORT),
+            websockets.serve(mux_handler, HOST, MUX_PORT)
         ]
+        config_channel.loop = asyncio.get_running_loop()
         await asyncio.gather(*servers)
+        asyncio.create_task(expire_sessions())
+        asyncio.create_task(resolve_server_uri())
         print("✅ WebSocket servers started successfully.")
     except Exception as e:
         print(f"❌ WebSocket startup failed: {e}")
 
+
+def start_relay(workers):
+    """Hands viewers to relay worker processes that share RELAY_PORT. Must run on the WebSocket loop."""
+    global relay_pool
+    if not hasattr(socket, "SO_REUSEPORT"):
+        print("❌ Relay workers need SO_REUSEPORT, which this platform lacks; viewers stay on this process")
+        return
+    config_channel.update({"relay_port": RELAY_PORT})  # Before the workers copy the config
+    relay_pool = relay.RelayPool(sys.modules[__name__], workers, RELAY_PORT)
+    relay_pool.start(asyncio.get_running_loop(), config_channel.snapshot())
+    atexit.register(relay_pool.close)
+
+
+def start_recording(directory, segment_bytes=recorder.SEGMENT_BYTES):
+    """Records every host's frames under a directory. Must run on the WebSocket loop, before hosts connect."""
+    global session_recorder
+    session_recorder = recorder.Recorder(directory, segment_bytes)
+    asyncio.create_task(session_recorder.run())
+    atexit.register(session_recorder.close)
+    print(f"💾 Recording sessions to {directory}")
+
+
+async def replay_session(session, recording, start, speed):
+    """Feeds a recording into a session as if its host were streaming it."""
+    print(f"⏪ Replaying {recording.host_id} into {session.host_id} at {speed}x")
+    session.host_connected = True
+    try:
+        async for message in recording.play(start, speed):
+            if sessions.get(session.host_id) is not session:
+                return  # Expired
+            session.last_active = time.time()
+            session.ingest_frame(message)
+    finally:
+        session.host_connected = False
+        print(f"⏹️ Replay {session.host_id} finished")
+
+
+def call_on_loop(function, *args):
+    """Runs a function on the WebSocket loop and returns its result.
+
+    Sessions, viewers and histograms are only changed by the handlers on that loop, so the Flask
+    thread reads them through here instead of racing the handlers.
+    """
+    loop = config_channel.loop
+    try:
+        on_loop = asyncio.get_running_loop() is loop
+    except RuntimeError:
+        on_loop = False
+    if on_loop or loop is None or not loop.is_running():
+        return function(*args)
+
+    async def call():
+        return function(*args)
+    return asyncio.run_coroutine_threadsafe(call(), loop).result()
+
+
+# Web routes, shared by the Flask app and the single-loop aiohttp app
+def config_json(changes=None):
+    if changes:
+        config_channel.update(changes)
+    snapshot = config_channel.snapshot()
+    return json.dumps(dict(snapshot["config"], config_version=snapshot["version"]))
+
+
+def sessions_json():
+    return json.dumps([session.stats() for session in list(sessions.values())])
+
+
+def viewers_json(host_id):
+    """Returns (body, status) for one session's viewer stats."""
+    session = sessions.get(host_id)
+    if session is None:
+        return json.dumps({"error": "Unknown session"}), 404
+    return json.dumps(session.frames.stats()), 200
+
+
+def recordings_json():
+    """Lists the recorded hosts with their time spans. Reads the disk, so call it off the WebSocket loop."""
+    if session_recorder is None:
+        return json.dumps([])
+    recordings = (session_recorder.open(host_id) for host_id in session_recorder.hosts())
+    return json.dumps([recording.summary() for recording in recordings if recording is not None])
+
+
+def replay_json(options):
+    """Starts replaying a host's recording into a new session. Options: host_id, start (Unix time, default the
+    beginning) and speed (default 1). Returns (body, status); the body names the session viewers open."""
+    if session_recorder is None:
+        return json.dumps({"error": "Recording is not enabled"}), 404
+    try:
+        host_id = str(options["host_id"])
+        start = options.get("start")
+        start = None if start is None else float(start)
+        speed = float(options.get("speed", 1))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return json.dumps({"error": "Expected host_id, and optionally start and speed"}), 400
+    # JSON bodies may carry NaN and Infinity, which would skip the pacing
+    if not (math.isfinite(speed) and speed > 0) or (start is not None and not math.isfinite(start)):
+        return json.dumps({"error": "start must be a finite time and speed a finite number above 0"}), 400
+    recording = session_recorder.open(host_id)
+    if recording is None:
+        return json.dumps({"error": "No recording for this host"}), 404
+    session = session_for(f"{recorder.REPLAY_PREFIX}{next(replay_numbers)}-{host_id}"[:64])
+    if session is None:
+        return json.dumps({"error": "Too many sessions"}), 503
+    asyncio.create_task(replay_session(session, recording, start, speed))
+    return json.dumps({"session": session.host_id}), 200
+
+
+def metrics_text():
+    """Latency histograms for every session, plus per-viewer queue gauges, in the Prometheus text format."""
+    entries = []
+    for session in list(sessions.values()):
+        entries.extend(session.metrics.entries(session=session.host_id))
+        for viewer in session.frames.stats()["viewers"]:
+            labels = {"session": session.host_id, "viewer": viewer["address"]}
+            entries.append(("trisma_viewer_pending_frames", labels, viewer["pending"]))
+            entries.append(("trisma_viewer_write_buffer_bytes", labels, viewer["buffered_bytes"]))
+            entries.append(("trisma_viewer_dropped_frames", labels, viewer["dropped"]))
+            if viewer["lag"] is not None:
+                entries.append(("trisma_viewer_lag_frames", labels, viewer["lag"]))
+    return metrics.render(entries)
+
+
+METRICS_MIMETYPE = "text/plain; version=0.0.4"
+
 # Flask Routes
 @app.route("/")
 def index():
@@ -151,22 +1167,130 @@ def index():
 
 @app.route("/config", methods=["GET", "POST"])
 def get_config():
-    global config
-    if request.method == "POST":
-        config.update(request.get_json())
-    return json.dumps(config)
+    changes = request.get_json() if request.method == "POST" else None
+    if changes is not None and not isinstance(changes, dict):
+        return Response("Expected a JSON object", status=400)
+    return config_json(changes)
+
+@app.route("/sessions")
+def get_sessions():
+    return call_on_loop(sessions_json)
+
+@app.route("/sessions/<host_id>/viewers")
+def get_viewers(host_id):
+    body, status = call_on_loop(viewers_json, host_id)
+    return Response(body, status=status, mimetype="application/json")
+
+@app.route("/metrics")
+def get_metrics():
+    return Response(call_on_loop(metrics_text), mimetype=METRICS_MIMETYPE)
+
+@app.route("/recordings")
+def get_recordings():
+    return Response(recordings_json(), mimetype="application/json")
+
+@app.route("/replay", methods=["POST"])
+def post_replay():
+    body, status = call_on_loop(replay_json, request.get_json(silent=True) or {})
+    return Response(body, status=status, mimetype="application/json")
 
 # Run Flask in a Separate Thread
 def run_flask():
+    from flask_socketio import SocketIO  # Imported here so the single-loop mode never loads it
+    socketio = SocketIO(app, cors_allowed_origins="*")
     print(f"🚀 Flask running at http://{HOST}:{config.get('web_interface_port')}")
     socketio.run(app, host='0.0.0.0', port=config.get('web_interface_port'), debug=DEBUG, use_reloader=False)
 
 
+# Single-loop mode: the same routes served by aiohttp on the WebSocket event loop
+async def web_index(request):
+    return web.FileResponse(f"{app.root_path}/{app.template_folder}/index.html")
+
+
+async def web_config(request):
+    try:
+        changes = await request.json() if request.method == "POST" else None
+    except ValueError:
+        raise web.HTTPBadRequest(text="Invalid JSON")
+    if changes is not None and not isinstance(changes, dict):
+        raise web.HTTPBadRequest(text="Expected a JSON object")
+    return web.Response(text=config_json(changes), content_type="application/json")
+
+
+async def web_sessions(request):
+    return web.Response(text=sessions_json(), content_type="application/json")
+
+
+async def web_viewers(request):
+    body, status = viewers_json(request.match_info["host_id"])
+    return web.Response(text=body, status=status, content_type="application/json")
+
+
+async def web_metrics(request):
+    return web.Response(text=metrics_text(), headers={"Content-Type": METRICS_MIMETYPE})
+
+
+async def web_recordings(request):
+    body = await asyncio.to_thread(recordings_json)
+    return web.Response(text=body, content_type="application/json")
+
+
+async def web_replay(request):
+    try:
+        options = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text="Invalid JSON")
+    body, status = replay_json(options)
+    return web.Response(text=body, status=status, content_type="application/json")
+
+
+def make_web_app():
+    web_app = web.Application()
+    web_app.add_routes([
+        web.get("/", web_index),
+        web.get("/config", web_config),
+        web.post("/config", web_config),
+        web.get("/sessions", web_sessions),
+        web.get("/sessions/{host_id}/viewers", web_viewers),
+        web.get("/metrics", web_metrics),
+        web.get("/recordings", web_recordings),
+        web.post("/replay", web_replay),
+    ])
+    return web_app
+
+
+async def run_single_loop(relay_workers=0, record=None, segment_bytes=recorder.SEGMENT_BYTES):
+    """Serves the web interface and every WebSocket port from one event loop, without a Flask thread."""
+    if record:
+        start_recording(record, segment_bytes)
+    await start_websockets()
+    if relay_workers:
+        start_relay(relay_workers)
+    runner = web.AppRunner(make_web_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, config["web_interface_port"]).start()
+    print(f"🚀 Web interface running at http://{HOST}:{config['web_interface_port']} (single loop)")
+    await asyncio.Future()  # Run until interrupted
+
 
 # Main Execution
 if __name__ == "__main__":
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.create_task(start_websockets())
-    threading.Thread(target=run_flask, daemon=True).start()
-    loop.run_forever()
+    parser = argparse.ArgumentParser(description="Trisma relay server")
+    parser.add_argument("--single-loop", action="store_true", help="serve the web interface with aiohttp on the WebSocket loop instead of a Flask thread")
+    parser.add_argument("--relay-workers", type=int, default=0, help=f"serve viewers from this many worker processes on port {RELAY_PORT}")
+    parser.add_argument("--record", metavar="DIR", help="record every session to this directory, for replay through /replay")
+    parser.add_argument("--segment-mb", type=int, default=recorder.SEGMENT_BYTES // 2**20, help="size at which a recording starts a new segment file")
+    args = parser.parse_args()
+    segment_bytes = args.segment_mb * 2**20
+    if args.single_loop:
+        asyncio.run(run_single_loop(args.relay_workers, args.record, segment_bytes))
+    else:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        if args.record:
+            loop.call_soon(start_recording, args.record, segment_bytes)
+        loop.create_task(start_websockets())
+        if args.relay_workers:
+            loop.call_soon(start_relay, args.relay_workers)
+        threading.Thread(target=run_flask, daemon=True).start()
+        loop.run_forever()
@@ -0,0 +1,68 @@
+"""Micro-benchmark: control events decoded per second, binary protocol vs. JSON.
+
+Run with `python tests/bench_control_protocol.py`.
+"""
+import os
+import sys
+import json
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import protocol
+
+BATCH_SIZE = 16  # Events per message, roughly one relay batch at 60 Hz mouse sampling
+REPEAT = 5
+
+
+def sample_events():
+    """A realistic mix: mostly moves, plus a click and some typing."""
+    events = [{"action": "move", "x": i / BATCH_SIZE, "y": 0.5} for i in range(BATCH_SIZE - 6)]
+    events += [
+        {"action": "mousedown", "x": 0.25, "y": 0.75, "button": 0},
+        {"action": "mouseup", "x": 0.25, "y": 0.75, "button": 0},
+        {"action": "keydown", "key": "Shift"},
+        {"action": "keydown", "key": "A"},
+        {"action": "keyup", "key": "A"},
+        {"action": "keyup", "key": "Shift"},
+    ]
+    return events
+
+
+def legacy_json_event(event):
+    """An event as the old viewer page sent it, with the redundant keydown fields."""
+    if event["action"] == "keydown":
+        return dict(event, isModifier=event["key"] == "Shift", keys=[event["key"]])
+    return event
+
+
+def measure(label, function, events_per_call):
+    number = 20000
+    best = min(timeit.repeat(function, number=number, repeat=REPEAT))
+    rate = number * events_per_call / best
+    print(f"{label:<40} {rate:>14,.0f} events/s")
+    return rate
+
+
+def main():
+    events = sample_events()
+    binary_batch = protocol.encode_control_events(events)
+    json_batch = json.dumps(events)
+    binary_single = [protocol.encode_control_events([event]) for event in events]
+    json_single = [json.dumps(legacy_json_event(event)) for event in events]
+
+    print(f"Message size for {len(events)} events: binary {len(binary_batch)} B, JSON {len(json_batch)} B")
+    print(f"Mean single-event size: binary {sum(map(len, binary_single)) / len(events):.1f} B, "
+          f"legacy JSON {sum(map(len, json_single)) / len(events):.1f} B\n")
+
+    binary = measure("binary, batched", lambda: protocol.parse_control_message(binary_batch), len(events))
+    text = measure("JSON, batched", lambda: protocol.parse_control_message(json_batch), len(events))
+    measure("binary, one event per message",
+            lambda: [protocol.parse_control_message(m) for m in binary_single], len(events))
+    measure("legacy JSON, one event per message",
+            lambda: [json.loads(m) for m in json_single], len(events))
+    measure("binary encode, batched", lambda: protocol.encode_control_events(events), len(events))
+    print(f"\nBatched binary decode is {binary / text:.2f}x JSON")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""Headless benchmark of the capture-to-viewer pipeline.
+
+The real client pipeline (client.stream_session) streams a synthetic screen to a loopback
+server, which relays it to a headless viewer that decodes and acknowledges every frame like the
+browser does. The server and viewer run in a child process so the parent's CPU time is the
+client's alone. Every combination of pattern, resolution multiplier and quality is measured for
+FPS, capture-to-decode latency percentiles, bytes per frame and CPU time per client stage.
+
+Run with `python tests/bench_pipeline.py`. Results are saved as JSON; pass --compare with an
+earlier result file to fail on regressions.
+"""
+import os
+import sys
+import io
+import json
+import time
+import types
+import zlib
+import asyncio
+import argparse
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import numpy as np
+
+WIDTH, HEIGHT = 1920, 1080
+PATTERNS = ("static", "scrolling", "video")
+SCROLL_SPEED = 12  # Pixels per grab
+WALL_STAGES = ("send", "pipeline")  # Timed as intervals by the client, not as CPU time
+WARMUP = 1.5  # Seconds streamed before measuring, so the first keyframe and config push are excluded
+
+
+class SyntheticShot:
+    """Stands in for an mss ScreenShot: a size plus the pixels in the layouts mss offers."""
+
+    def __init__(self, pixels):
+        self.height, self.width = pixels.shape[:2]
+        self.size = (self.width, self.height)
+        # Like mss, the grab itself is a fresh BGRA bytearray; the other layouts are converted from it
+        bgra = np.empty((self.height, self.width, 4), dtype=np.uint8)
+        bgra[..., :3] = pixels[..., ::-1]
+        bgra[..., 3] = 255
+        self.raw = bytearray(bgra.tobytes())
+
+    @property
+    def rgb(self):
+        return np.frombuffer(self.raw, dtype=np.uint8).reshape(self.height, self.width, 4)[..., 2::-1].tobytes()
+
+    @property
+    def bgra(self):
+        return bytes(self.raw)
+
+
+def make_text(height, width, rng):
+    """Dark glyph-like dashes in lines on a white page."""
+    page = np.full((height, width, 3), 250, dtype=np.uint8)
+    for top in range(8, height - 16, 20):
+        x = 16
+        while x < width - 40:
+            word = int(rng.integers(12, 60))
+            page[top:top + 11, x:min(x + word, width - 16)] = rng.integers(20, 70)
+            x += word + 8
+    return page
+
+
+class SyntheticScreen:
+    """Generates the frames of one pattern; grab() is called from the client's grab thread."""
+
+    def __init__(self, pattern, width=WIDTH, height=HEIGHT):
+        rng = np.random.default_rng(1)
+        self.pattern = pattern
+        self.width, self.height = width, height
+        self.grabs = 0
+        y, x = np.mgrid[0:height, 0:width]
+        desktop = np.stack([40 + 60 * y // height, 90 + 40 * x // width, 140 + 0 * x], axis=2).astype(np.uint8)
+        # A window with a title bar, taking most of the screen
+        self.window = (slice(height // 10, height * 9 // 10), slice(width // 8, width * 7 // 8))
+        window_height = self.window[0].stop - self.window[0].start
+        window_width = self.window[1].stop - self.window[1].start
+        desktop[self.window] = make_text(window_height, window_width, rng)
+        desktop[self.window[0].start - 24:self.window[0].start, self.window[1]] = (60, 60, 70)
+        self.desktop = desktop
+        if pattern == "scrolling":
+            document = make_text(window_height * 3, window_width, rng)
+            self.document = np.concatenate([document, document[:window_height]])  # Wraps around seamlessly
+            self.document_height = len(document)
+        elif pattern == "video":
+            # A smooth texture twice the screen size, panned and colour-cycled so every pixel moves
+            ty, tx = np.mgrid[0:height * 2, 0:width * 2].astype(np.float32)
+            texture = np.stack([
+                np.sin(tx / 37) + np.sin(ty / 23),
+                np.sin((tx + ty) / 41) + np.cos(ty / 19),
+                np.cos(tx / 29) + np.sin((tx - ty) / 53),
+            ], axis=2)
+            self.texture = ((texture + 2) * 63).astype(np.uint8)
+        elif pattern != "static":
+            raise ValueError(f"Unknown pattern {pattern}")
+
+    def frame(self, index):
+        if self.pattern == "static":
+            frame = self.desktop.copy()
+            if (index // 8) % 2:  # A blinking caret is the only change
+                frame[200:216, 400:402] = 0
+            return frame
+        if self.pattern == "scrolling":
+            frame = self.desktop.copy()
+            offset = (index * SCROLL_SPEED) % self.document_height
+            rows = self.window[0].stop - self.window[0].start
+            frame[self.window] = self.document[offset:offset + rows]
+            return frame
+        x = int((np.sin(index / 40) + 1) / 2 * self.width)
+        y = int((np.cos(index / 55) + 1) / 2 * self.height)
+        return self.texture[y:y + self.height, x:x + self.width] + np.uint8(index * 3 % 256)
+
+    def grab(self):
+        self.grabs += 1
+        return SyntheticShot(self.frame(self.grabs))
+
+
+def import_headless_client():
+    """Imports client.py with stand-ins for the input and audio devices, which the benchmark never uses."""
+    for name in ("pyautogui", "pyaudio"):
+        sys.modules[name] = types.ModuleType(name)
+    sys.modules["pyautogui"].size = lambda: (WIDTH, HEIGHT)
+    sys.modules["pyautogui"].position = lambda: (0, 0)  # Sampled for the cursor channel
+    sys.modules["pyaudio"].paInt16 = 8
+    sys.modules["pyaudio"].paContinue = 0
+    import client
+    return client
+
+
+def percentile_ms(values, q):
+    """Returns a percentile of durations in seconds as milliseconds, or None without samples."""
+    return float(np.percentile(values, q)) * 1000 if values else None
+
+
+# Loopback server and headless viewer (child process)
+def decode_frame(message):
+    """Decodes every image in a frame message, as the browser would."""
+    import protocol
+    from PIL import Image
+    header = protocol.unpack_header(message)
+    if header.kind == protocol.FRAME_FULL:
+        images = [memoryview(message)[protocol.FRAME_HEADER.size:]]
+    else:
+        images = [image for _, _, _, _, image in protocol.iter_tiles(message)]
+    for image in images:
+        data = bytes(image)
+        if header.flags & protocol.FLAG_DEFLATE:
+            data = zlib.decompress(data)
+        if header.codec != protocol.CODEC_RAW:
+            Image.open(io.BytesIO(data)).load()
+    return header
+
+
+async def headless_viewer(port, host_id, stats):
+    """Watches a session over the multiplexed connection, decoding and acknowledging every frame."""
+    import websockets
+    import protocol
+    async with websockets.connect(f"ws://127.0.0.1:{port}/{host_id}?role=viewer", max_size=None) as websocket:
+        assembler = protocol.MuxAssembler()
+        async for fragment in websocket:
+            message = assembler.feed(fragment)
+            if message is None or message[0] != protocol.CHANNEL_VIDEO:
+                continue
+            received_at = time.time()
+            header = await asyncio.to_thread(decode_frame, message[1])
+            decoded_at = time.time()
+            if stats["measuring"]:
+                stats["frames"] += 1
+                stats["bytes"] += len(message[1])
+                stats["keyframes"] += header.kind == protocol.FRAME_FULL
+                stats["latency"].append(decoded_at - header.timestamp)  # Same machine, same clock
+                stats["decode"].append(decoded_at - received_at)
+            ack = json.dumps({"ack": header.sequence, "decode": decoded_at - received_at, "paint": 0})
+            await websocket.send(b"".join(protocol.mux_fragments(protocol.CHANNEL_VIDEO, ack)))
+
+
+async def relay_main(port, pipe):
+    import websockets
+    import server
+    server.config_channel.loop = asyncio.get_running_loop()
+    server.config.update(server_uri="127.0.0.1", mux_port=port)
+    await websockets.serve(server.mux_handler, "127.0.0.1", port, max_size=None)
+    pipe.send("ready")
+    viewer = stats = None
+    while True:
+        command, argument = await asyncio.to_thread(pipe.recv)
+        if command == "config":
+            server.config_channel.update(argument)
+        elif command == "watch":
+            stats = {"measuring": False, "frames": 0, "bytes": 0, "keyframes": 0, "latency": [], "decode": []}
+            viewer = asyncio.create_task(headless_viewer(port, argument, stats))
+        elif command == "measure":
+            stats["measuring"] = True
+        elif command == "stop":
+            viewer.cancel()
+            session = server.sessions.get(argument)
+            stages = {}
+            if session is not None:
+                for name, labels, histogram in session.metrics.entries():
+                    if name == "trisma_client_stage_seconds":
+                        stages[labels["stage"]] = (histogram.sum, histogram.count)
+            pipe.send((stats, stages))
+        elif command == "exit":
+            return
+
+
+def relay_process(port, pipe):
+    asyncio.run(relay_main(port, pipe))
+
+
+# Client (parent process)
+async def run_case(client, relay, port, pattern, multiplier, quality, args):
+    """Streams one pattern at one setting and returns its measurements."""
+    host_id = f"bench-{pattern}-{multiplier}-{quality}"
+    screen = SyntheticScreen(pattern)
+    client.grab_screen = screen.grab
+    client.HOST_ID = host_id
+    relay.send(("config", {
+        "resolution_multiplier": multiplier, "max_quality": quality,
+        "refresh_rate": args.fps, "adaptive_quality": False,
+    }))
+    relay.send(("watch", host_id))
+    stream = asyncio.create_task(client.stream_session())
+    await asyncio.sleep(WARMUP)
+
+    relay.send(("measure", None))
+    start_time, start_cpu, start_grabs = time.time(), time.process_time(), screen.grabs
+    await asyncio.sleep(args.duration)
+    grabs = screen.grabs - start_grabs
+    elapsed, cpu = time.time() - start_time, time.process_time() - start_cpu
+    relay.send(("stop", host_id))
+    stats, stages = await asyncio.to_thread(relay.recv)
+    stream.cancel()
+    await asyncio.gather(stream, return_exceptions=True)
+
+    frames = stats["frames"]
+    return {
+        "pattern": pattern,
+        "resolution_multiplier": multiplier,
+        "quality": quality,
+        "fps": frames / elapsed,  # Frames delivered; unchanged grabs are never sent
+        "capture_fps": grabs / elapsed,
+        "frames": frames,
+        "keyframes": stats["keyframes"],
+        "bytes_per_frame": stats["bytes"] / frames if frames else None,
+        "latency_ms": {f"p{q}": percentile_ms(stats["latency"], q) for q in (50, 95, 99)},
+        "viewer_decode_ms": percentile_ms(stats["decode"], 50),
+        # Per frame, over warm-up and measurement alike: CPU time of each client stage's thread, and
+        # the wall time of the send and of the whole pipeline, which include waiting in queues
+        "stage_cpu_ms": {stage: total / count * 1000 for stage, (total, count) in stages.items() if count and stage not in WALL_STAGES},
+        "stage_wall_ms": {stage: total / count * 1000 for stage, (total, count) in stages.items() if count and stage in WALL_STAGES},
+        "client_cpu_percent": cpu / elapsed * 100,
+    }
+
+
+async def run_all(args):
+    client = import_headless_client()
+    client.BASE_URI, client.MUX_PORT = "127.0.0.1", args.port
+    client.audio_packets = asyncio.Queue()  # No microphone; the audio channel stays idle
+
+    context = multiprocessing.get_context("spawn")
+    relay, child_end = context.Pipe()
+    process = context.Process(target=relay_process, args=(args.port, child_end), daemon=True)
+    process.start()
+    await asyncio.to_thread(relay.recv)  # "ready"
+
+    results = []
+    try:
+        for pattern in args.patterns:
+            for multiplier in args.multipliers:
+                for quality in args.qualities:
+                    result = await run_case(client, relay, args.port, pattern, multiplier, quality, args)
+                    results.append(result)
+                    print_result(result)
+    finally:
+        relay.send(("exit", None))
+        process.join(5)
+    return results
+
+
+def print_result(result):
+    latency = result["latency_ms"]
+    stages = " ".join(f"{stage}={ms:.1f}" for stage, ms in result["stage_cpu_ms"].items())
+    stages += " | wall " + " ".join(f"{stage}={ms:.1f}" for stage, ms in result["stage_wall_ms"].items())
+    print(f"{result['pattern']:<10} x{result['resolution_multiplier']:<4} q{result['quality']:<3} "
+          f"{result['fps']:5.1f} fps ({result['capture_fps']:4.1f} grabbed)  p50 {latency['p50'] or 0:6.1f} ms  p95 {latency['p95'] or 0:6.1f} ms  "
+          f"{(result['bytes_per_frame'] or 0) / 1024:7.1f} KiB/frame  cpu {result['client_cpu_percent']:4.0f}%  [{stages}]")
+
+
+def compare(results, baseline_path, tolerance):
+    """Prints cases whose FPS fell or p95 latency rose by more than the tolerance. Returns the count."""
+    with open(baseline_path) as baseline_file:
+        baseline = {(r["pattern"], r["resolution_multiplier"], r["quality"]): r for r in json.load(baseline_file)["results"]}
+    regressions = 0
+    for result in results:
+        before = baseline.get((result["pattern"], result["resolution_multiplier"], result["quality"]))
+        if before is None:
+            continue
+        name = f"{result['pattern']} x{result['resolution_multiplier']} q{result['quality']}"
+        if result["fps"] < before["fps"] * (1 - tolerance):
+            print(f"❌ {name}: {before['fps']:.1f} -> {result['fps']:.1f} fps")
+            regressions += 1
+        old, new = before["latency_ms"]["p95"], result["latency_ms"]["p95"]
+        if old and new and new > old * (1 + tolerance):
+            print(f"❌ {name}: p95 latency {old:.1f} -> {new:.1f} ms")
+            regressions += 1
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--patterns", type=lambda s: s.split(","), default=list(PATTERNS))
+    parser.add_argument("--multipliers", type=lambda s: [float(v) for v in s.split(",")], default=[1.0, 0.5])
+    parser.add_argument("--qualities", type=lambda s: [int(v) for v in s.split(",")], default=[80, 50])
+    parser.add_argument("--fps", type=int, default=30, help="Refresh rate requested from the client")
+    parser.add_argument("--duration", type=float, default=5, help="Seconds measured per case")
+    parser.add_argument("--port", type=int, default=17777)
+    parser.add_argument("--output", default="bench_pipeline.json")
+    parser.add_argument("--compare", help="Earlier result file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = asyncio.run(run_all(args))
+    with open(args.output, "w") as output:
+        json.dump({"created": time.time(), "cpu_count": os.cpu_count(), "screen": [WIDTH, HEIGHT],
+                   "fps_target": args.fps, "results": results}, output, indent=2)
+    print(f"Results saved to {args.output}")
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,345 @@
+"""Load test of server.py fan-out: N simulated hosts replaying a recorded frame stream to M viewers.
+
+The server runs as in production (asyncio WebSocket loop plus the Flask-SocketIO thread, or the
+aiohttp single-loop mode with --single-loop) in its own process, with a monitor that samples event-loop stalls and memory. With
+--relay-workers the server hands viewers to that many relay worker processes. Hosts and viewers are spread over worker processes so the load generator is not the bottleneck. Each step of the N x M
+sweep reports relay throughput, per-viewer latency, delivered share of frames, event-loop stall
+time, /config response time and server memory growth.
+
+Run with `python tests/load_relay.py --hosts 1,4,16 --viewers 4,32,128`. Results are saved as JSON.
+"""
+import os
+import sys
+import json
+import time
+import struct
+import asyncio
+import argparse
+import threading
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import numpy as np
+from bench_pipeline import SyntheticScreen, import_headless_client, percentile_ms
+import protocol
+
+SERVER_PORTS = ("IMAGE_RECEIVER_PORT", "IMAGE_SENDER_PORT", "CONTROL_PORT", "CONTROL_SENDER_PORT",
+                "VOICE_SENDER_PORT", "CONFIG_PORT", "MUX_PORT", "RELAY_PORT")
+STALL_INTERVAL = 0.005  # Seconds the monitor sleeps; any overshoot is time the loop was busy elsewhere
+STREAM_RECORD = struct.Struct("!I")  # Length prefix of every message in a saved stream, 0 for "no change"
+
+
+def record_stream(pattern, count, multiplier, quality):
+    """Encodes a synthetic screen with the client's own pipeline. Unchanged grabs are None."""
+    client = import_headless_client()
+    screen = SyntheticScreen(pattern)
+    size = (int(screen.width * multiplier), int(screen.height * multiplier))
+    stream, previous = [], None
+    for index in range(count):
+        frame = client.prepare_frame(screen.grab(), size)
+        plan = client.plan_frame(frame, previous, force_keyframe=index == 0)
+        previous = frame
+        if plan == ([], []):
+            stream.append(None)
+            continue
+        header = protocol.make_header(client.FRAME_CODEC, size[0], size[1], index, client.frame_flags())
+        stream.append(client.encode_frame(frame, header, plan, quality))
+    return stream
+
+
+def save_stream(stream, path):
+    with open(path, "wb") as output:
+        for message in stream:
+            output.write(STREAM_RECORD.pack(len(message) if message else 0))
+            output.write(message or b"")
+
+
+def load_stream(path):
+    stream = []
+    with open(path, "rb") as source:
+        while header := source.read(STREAM_RECORD.size):
+            (length,) = STREAM_RECORD.unpack(header)
+            stream.append(source.read(length) if length else None)
+    return stream
+
+
+def memory_usage():
+    """Resident set size of this process in bytes."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Peak, not current, off Linux
+
+
+# Server process
+async def monitor_server(server, relay_workers, pipe):
+    """Samples event-loop stalls and answers the harness's reset and report commands."""
+    stalls = []
+
+    async def sample():
+        while True:
+            start_time = time.perf_counter()
+            await asyncio.sleep(STALL_INTERVAL)
+            stalls.append(time.perf_counter() - start_time - STALL_INTERVAL)
+
+    sampler = asyncio.create_task(sample())
+    pipe.send((server.MUX_PORT, server.RELAY_PORT if relay_workers else server.MUX_PORT))  # Host port, viewer port
+    while True:
+        command = await asyncio.to_thread(pipe.recv)
+        if command == "reset":
+            stalls.clear()
+        elif command == "report":
+            viewers = sum(session.frames.viewer_count() for session in list(server.sessions.values()))
+            pipe.send({
+                "stall_p99_ms": percentile_ms(stalls, 99),
+                "stall_max_ms": max(stalls) * 1000 if stalls else None,
+                "stalled_share": sum(stalls) / (len(stalls) * STALL_INTERVAL + sum(stalls)) if stalls else None,
+                "rss_bytes": memory_usage(),
+                "sessions": len(server.sessions),
+                "viewers": viewers,
+            })
+        elif command == "exit":
+            sampler.cancel()
+            asyncio.get_running_loop().stop()
+            return
+
+
+def server_process(port_offset, web_port, single_loop, relay_workers, pipe):
+    """Starts server.py the way its __main__ does, on shifted ports, plus the monitor."""
+    import server
+    for name in SERVER_PORTS:
+        setattr(server, name, getattr(server, name) + port_offset)
+    server.config.update(
+        server_uri="127.0.0.1", web_interface_port=web_port, mux_port=server.MUX_PORT,
+        image_receiver_port=server.IMAGE_RECEIVER_PORT, image_sender_port=server.IMAGE_SENDER_PORT,
+        control_port=server.CONTROL_PORT, control_sender_port=server.CONTROL_SENDER_PORT,
+        voice_sender_port=server.VOICE_SENDER_PORT, config_port=server.CONFIG_PORT,
+    )
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if single_loop:
+        loop.create_task(server.run_single_loop(relay_workers))
+    else:
+        loop.create_task(server.start_websockets())
+        if relay_workers:
+            loop.call_soon(server.start_relay, relay_workers)
+        threading.Thread(target=server.run_flask, daemon=True).start()
+    loop.create_task(monitor_server(server, relay_workers, pipe))
+    loop.run_forever()
+
+
+# Load generator processes
+async def replay_host(port, host_id, stream, fps, stats):
+    """Streams the recording in a loop, restamping every frame with a new sequence number and time."""
+    import websockets
+    import mux
+    async with websockets.connect(f"ws://127.0.0.1:{port}/{host_id}?role=host", max_size=None) as websocket:
+        connection = mux.MuxConnection(websocket)
+        tasks = [asyncio.create_task(connection.run_writer()), asyncio.create_task(drain(connection))]
+        try:
+            sequence = 0
+            next_frame = time.perf_counter()
+            while True:
+                for message in stream:
+                    if message is not None:
+                        header = protocol.unpack_header(message)._replace(sequence=sequence, timestamp=time.time())
+                        await connection.send(protocol.CHANNEL_VIDEO, protocol.FRAME_HEADER.pack(*header) + message[protocol.FRAME_HEADER.size:])
+                        sequence += 1
+                        if stats["measuring"]:
+                            stats["frames"] += 1
+                            stats["bytes"] += len(message)
+                    next_frame += 1 / fps
+                    await asyncio.sleep(max(0, next_frame - time.perf_counter()))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+async def drain(connection):
+    """Reads and discards feedback and config pushes."""
+    async for _ in connection.messages():
+        pass
+
+
+async def watch(port, host_id, stats):
+    """A viewer that acknowledges every frame without decoding it, so only relay cost is measured."""
+    import websockets
+    async with websockets.connect(f"ws://127.0.0.1:{port}/{host_id}?role=viewer", max_size=None) as websocket:
+        assembler = protocol.MuxAssembler()
+        async for fragment in websocket:
+            message = assembler.feed(fragment)
+            if message is None or message[0] != protocol.CHANNEL_VIDEO:
+                continue
+            header = protocol.unpack_header(message[1])
+            if stats["measuring"]:
+                stats["frames"] += 1
+                stats["bytes"] += len(message[1])
+                stats["latency"].append(time.time() - header.timestamp)  # Same machine, same clock
+            ack = json.dumps({"ack": header.sequence})
+            await websocket.send(b"".join(protocol.mux_fragments(protocol.CHANNEL_VIDEO, ack)))
+
+
+async def worker_main(ports, hosts, viewers, stream, args):
+    host_port, viewer_port = ports
+    host_stats = [{"measuring": False, "frames": 0, "bytes": 0} for _ in hosts]
+    viewer_stats = [{"measuring": False, "frames": 0, "bytes": 0, "latency": []} for _ in viewers]
+    tasks = [asyncio.create_task(watch(viewer_port, host_id, stats)) for host_id, stats in zip(viewers, viewer_stats)]
+    await asyncio.sleep(0.5)  # Viewers first, so every one of them starts from the first keyframe
+    tasks += [asyncio.create_task(replay_host(host_port, host_id, stream, args.fps, stats)) for host_id, stats in zip(hosts, host_stats)]
+    await asyncio.sleep(args.warmup)
+    for stats in host_stats + viewer_stats:
+        stats["measuring"] = True
+    await asyncio.sleep(args.duration)
+    for stats in host_stats + viewer_stats:
+        stats["measuring"] = False
+    failed = sum(task.done() for task in tasks)  # Connections that were refused or dropped
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return {
+        "hosts": [{"frames": s["frames"], "bytes": s["bytes"]} for s in host_stats],
+        "viewers": [{"frames": s["frames"], "bytes": s["bytes"], "p50_ms": percentile_ms(s["latency"], 50),
+                     "p95_ms": percentile_ms(s["latency"], 95), "max_ms": percentile_ms(s["latency"], 100)}
+                    for s in viewer_stats],
+        "failed_connections": failed,
+    }
+
+
+def worker_process(ports, hosts, viewers, stream, args, results):
+    results.put(asyncio.run(worker_main(ports, hosts, viewers, stream, args)))
+
+
+# Harness
+def probe_config(web_port, stop, samples):
+    """Times GET /config while the step runs, as a measure of how the Flask thread keeps up."""
+    import requests
+    while not stop.is_set():
+        start_time = time.perf_counter()
+        try:
+            requests.get(f"http://127.0.0.1:{web_port}/config", timeout=5)
+            samples.append(time.perf_counter() - start_time)
+        except requests.exceptions.RequestException:
+            samples.append(5.0)
+        stop.wait(0.2)
+
+
+def run_step(context, server_pipe, ports, web_port, stream, hosts, viewers, args):
+    host_ids = [f"load-{hosts}x{viewers}-{index}" for index in range(hosts)]
+    assignments = [([], []) for _ in range(args.workers)]
+    for index, host_id in enumerate(host_ids):
+        assignments[index % args.workers][0].append(host_id)
+    for index in range(viewers):
+        assignments[index % args.workers][1].append(host_ids[index % hosts])
+
+    server_pipe.send("report")
+    rss_before = server_pipe.recv()["rss_bytes"]
+    results = context.Queue()
+    workers = [context.Process(target=worker_process, args=(ports, own_hosts, own_viewers, stream, args, results), daemon=True)
+               for own_hosts, own_viewers in assignments if own_hosts or own_viewers]
+    for worker in workers:
+        worker.start()
+
+    time.sleep(0.5 + args.warmup)
+    server_pipe.send("reset")
+    stop, config_times = threading.Event(), []
+    prober = threading.Thread(target=probe_config, args=(web_port, stop, config_times), daemon=True)
+    prober.start()
+    time.sleep(args.duration)
+    server_pipe.send("report")
+    server_stats = server_pipe.recv()
+    stop.set()
+
+    worker_results = [results.get(timeout=60) for _ in workers]
+    for worker in workers:
+        worker.join(5)
+    viewer_results = [viewer for result in worker_results for viewer in result["viewers"]]
+    sent = sum(host["frames"] for result in worker_results for host in result["hosts"])
+    received = sum(viewer["frames"] for viewer in viewer_results)
+    expected = sent * viewers / hosts  # Every viewer watches one host; hosts all run at the same rate
+    p95s = [viewer["p95_ms"] for viewer in viewer_results if viewer["p95_ms"] is not None]
+    return {
+        "hosts": hosts,
+        "viewers": viewers,
+        "host_fps": sent / hosts / args.duration,
+        "relayed_fps": received / args.duration,
+        "relayed_mbit_s": sum(viewer["bytes"] for viewer in viewer_results) * 8 / args.duration / 1e6,
+        "delivered_share": received / expected if expected else None,
+        "viewer_p95_ms": {"median": float(np.median(p95s)) if p95s else None, "worst": max(p95s) if p95s else None},
+        "viewer_max_ms": max((viewer["max_ms"] or 0 for viewer in viewer_results), default=None),
+        "starved_viewers": sum(not viewer["frames"] for viewer in viewer_results),
+        "failed_connections": sum(result["failed_connections"] for result in worker_results),
+        "stall_p99_ms": server_stats["stall_p99_ms"],
+        "stall_max_ms": server_stats["stall_max_ms"],
+        "loop_busy_share": server_stats["stalled_share"],
+        "config_p95_ms": percentile_ms(config_times, 95),
+        "rss_mb": server_stats["rss_bytes"] / 2**20,
+        "rss_growth_mb": (server_stats["rss_bytes"] - rss_before) / 2**20,
+    }
+
+
+def print_step(step):
+    print(f"{step['hosts']:>4} hosts {step['viewers']:>5} viewers  "
+          f"{step['host_fps']:5.1f} fps/host  {step['relayed_fps']:7.1f} fps relayed  {step['relayed_mbit_s']:7.1f} Mbit/s  "
+          f"delivered {100 * (step['delivered_share'] or 0):5.1f}%  p95 {step['viewer_p95_ms']['worst'] or 0:7.1f} ms worst  "
+          f"stall p99 {step['stall_p99_ms'] or 0:6.1f} ms  /config p95 {step['config_p95_ms'] or 0:6.1f} ms  "
+          f"rss {step['rss_mb']:6.1f} MB (+{step['rss_growth_mb']:.1f})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--hosts", type=lambda s: [int(v) for v in s.split(",")], default=[1, 4])
+    parser.add_argument("--viewers", type=lambda s: [int(v) for v in s.split(",")], default=[4, 16])
+    parser.add_argument("--pattern", default="scrolling", help="Synthetic screen to record: static, scrolling or video")
+    parser.add_argument("--stream", help="Replay a stream saved with --save-stream instead of recording one")
+    parser.add_argument("--save-stream", help="Save the recorded stream for later runs")
+    parser.add_argument("--stream-frames", type=int, default=60)
+    parser.add_argument("--multiplier", type=float, default=0.5)
+    parser.add_argument("--quality", type=int, default=70)
+    parser.add_argument("--fps", type=float, default=15, help="Frame rate of every simulated host")
+    parser.add_argument("--warmup", type=float, default=2)
+    parser.add_argument("--duration", type=float, default=5, help="Seconds measured per step")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1), help="Load generator processes")
+    parser.add_argument("--port-offset", type=int, default=20000, help="Added to every server port")
+    parser.add_argument("--web-port", type=int, default=28080)
+    parser.add_argument("--single-loop", action="store_true", help="Run the server's aiohttp single-loop mode")
+    parser.add_argument("--relay-workers", type=int, default=0, help="Serve viewers from this many server relay processes")
+    parser.add_argument("--output", default="load_relay.json")
+    args = parser.parse_args()
+
+    if args.stream:
+        stream = load_stream(args.stream)
+    else:
+        print(f"Recording {args.stream_frames} frames of the {args.pattern} pattern...")
+        stream = record_stream(args.pattern, args.stream_frames, args.multiplier, args.quality)
+        if args.save_stream:
+            save_stream(stream, args.save_stream)
+    sizes = [len(message) for message in stream if message]
+    print(f"Stream: {len(sizes)}/{len(stream)} frames sent, {np.mean(sizes) / 1024:.1f} KiB mean")
+
+    context = multiprocessing.get_context("spawn")
+    server_pipe, child_end = context.Pipe()
+    server = context.Process(target=server_process, args=(args.port_offset, args.web_port, args.single_loop, args.relay_workers, child_end),
+                             daemon=not args.relay_workers)  # Daemonic processes cannot start the relay workers
+    server.start()
+    ports = server_pipe.recv()
+    time.sleep(3 if args.relay_workers else 1)  # Let the WebSocket and Flask servers bind, and the relay workers start
+
+    steps = []
+    try:
+        for hosts in args.hosts:
+            for viewers in args.viewers:
+                step = run_step(context, server_pipe, ports, args.web_port, stream, hosts, viewers, args)
+                steps.append(step)
+                print_step(step)
+    finally:
+        server_pipe.send("exit")
+        server.join(5)
+    with open(args.output, "w") as output:
+        json.dump({"created": time.time(), "cpu_count": os.cpu_count(), "args": vars(args), "steps": steps}, output, indent=2)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
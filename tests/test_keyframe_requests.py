@@ -0,0 +1,65 @@
+"""Headless checks that a keyframe request reaches the encoder while the host's screen is static.
+
+The grab stage skips grabs whose digest has not changed, so a request that only sets a flag waits for
+the screen to change; a viewer that needs a keyframe would stay blank until then.
+
+Run with `python -m pytest tests/test_keyframe_requests.py` or `python tests/test_keyframe_requests.py`.
+"""
+import os
+import sys
+import json
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_pipeline import SyntheticScreen, SyntheticShot, import_headless_client
+
+FRAME_WAIT = 3  # Seconds to wait for the requested frame; grabs run at least once a second
+
+
+async def frame_after(request):
+    """Streams an unchanging screen, makes a request after its first frame and returns whether another
+    frame reached the encoder."""
+    client = import_headless_client()
+    pixels = SyntheticScreen("static").frame(0)
+    client.grab_screen = lambda: SyntheticShot(pixels)
+    controller = client.AdaptiveController()
+    scheduler = client.CaptureScheduler()
+    frames = asyncio.Queue(maxsize=client.PIPELINE_DEPTH)
+    grabber = asyncio.create_task(client.grab_stage(frames, controller, scheduler))
+    try:
+        await (await frames.get())[2]  # The first grab always goes through
+        request(client, controller, scheduler)
+        try:
+            _, _, converting = await asyncio.wait_for(frames.get(), FRAME_WAIT)
+        except asyncio.TimeoutError:
+            return False
+        await converting
+        return scheduler.take_keyframe_request()
+    finally:
+        grabber.cancel()
+        await asyncio.gather(grabber, return_exceptions=True)
+
+
+def request_from_viewer(client, controller, scheduler):
+    client.handle_feedback(json.dumps({"keyframe": True}), controller, scheduler)
+
+
+def test_viewer_keyframe_request_on_static_screen():
+    assert asyncio.run(frame_after(request_from_viewer))
+
+
+def reconnect_without_resume(client, controller, scheduler):
+    scheduler.sent_sequence = 0  # The first frame went out before the connection dropped
+    scheduler.begin_resume()
+    client.handle_feedback(json.dumps({"viewers": 1, "watching": 1}), controller, scheduler)  # A restarted server
+
+
+def test_keyframe_after_unresumed_reconnect_on_static_screen():
+    assert asyncio.run(frame_after(reconnect_without_resume))
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"✅ {name}")